@@ -1,4 +1,42 @@
 from django.contrib import admin
-from cloud_profiles.models import Profile
+from cloud_profiles.models import DirectoryOperation, Profile, QueuedMail
+from cloud_profiles.views import activate_profiles, activation_email
+from cloud_profiles.mail import queue_mails
 
-admin.site.register(Profile)
+
+class ProfileAdmin(admin.ModelAdmin):
+    list_display = ('email', 'name', 'institution', 'country', 'status')
+    list_filter = ('status', 'country')
+    actions = ['activate', 'resend_activation']
+
+    def activate(self, request, queryset):
+        activate_profiles(request, queryset.select_related('user'))
+    activate.short_description = 'Activate selected profiles'
+
+    def resend_activation(self, request, queryset):
+        profiles = [p for p in queryset if p.reissue_password_key()]
+        queue_mails([activation_email(request, p) for p in profiles])
+        self.message_user(request, 'Activation link sent to %d profiles' %
+                                   len(profiles))
+    resend_activation.short_description = ('Send a new activation link to '
+                                           'the selected profiles')
+
+
+admin.site.register(Profile, ProfileAdmin)
+admin.site.register(QueuedMail)
+
+
+class DirectoryOperationAdmin(admin.ModelAdmin):
+    list_display = ('op', 'dn', 'status', 'attempts', 'next_attempt',
+                    'created')
+    list_filter = ('status', 'op')
+    exclude = ('data', )
+    actions = ['requeue']
+
+    def requeue(self, request, queryset):
+        n = DirectoryOperation.objects.requeue(queryset)
+        self.message_user(request, '%d failed operations requeued' % n)
+    requeue.short_description = 'Retry the selected failed operations'
+
+
+admin.site.register(DirectoryOperation, DirectoryOperationAdmin)
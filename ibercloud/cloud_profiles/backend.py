@@ -3,8 +3,56 @@
 # checking the user profile
 #
 
-from models import Profile
-from django.contrib.auth import get_user_model
+import copy
+
+from django.conf import settings
+from django.contrib.auth import (get_user_model, load_backend,
+                                 BACKEND_SESSION_KEY, SESSION_KEY)
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_init, post_save
+
+from models import Profile, profiles_activated
+from lru import LRUCache
+
+# Per process caches of DN -> user id and user id -> user. Changes are
+# invalidated locally, other processes see them after the ttl expires.
+_cache_size = getattr(settings, 'CLOUD_PROFILES_X509_CACHE_SIZE', 1000)
+_cache_ttl = getattr(settings, 'CLOUD_PROFILES_X509_CACHE_TTL', 60)
+dn_cache = LRUCache(_cache_size, _cache_ttl)
+user_cache = LRUCache(_cache_size, _cache_ttl)
+
+
+def cache_stats():
+    return {'dn': dn_cache.stats(), 'user': user_cache.stats()}
+
+
+def _remember_dn(sender, instance, **kwargs):
+    # the DN the profile was loaded with, dropped if it changes
+    instance._cached_dn = instance.user_dn
+
+
+def _invalidate_profile(sender, instance, **kwargs):
+    for dn in set([instance._cached_dn, instance.user_dn]):
+        dn_cache.delete(dn)
+    instance._cached_dn = instance.user_dn
+    user_cache.delete(instance.user_id)
+
+
+def _invalidate_user(sender, instance, **kwargs):
+    user_cache.delete(instance.pk)
+
+
+def _invalidate_activated(sender, profiles, **kwargs):
+    for p in profiles:
+        user_cache.delete(p.user_id)
+
+
+post_init.connect(_remember_dn, sender=Profile)
+post_save.connect(_invalidate_profile, sender=Profile)
+post_delete.connect(_invalidate_profile, sender=Profile)
+post_save.connect(_invalidate_user, sender=get_user_model())
+post_delete.connect(_invalidate_user, sender=get_user_model())
+profiles_activated.connect(_invalidate_activated, sender=Profile)
 
 
 class X509Backend(object):
@@ -14,17 +62,61 @@ class X509Backend(object):
 
     def authenticate(self, username=None, password=None, user_dn=None):
         if user_dn:
-            try:
-                profile = Profile.objects.get(user_dn=user_dn)
-                if profile.user and profile.user.is_active:
-                    return profile.user
-            except (Profile.DoesNotExist, Profile.MultipleObjectsReturned):
-                pass 
+            user_id = dn_cache.get(user_dn)
+            if user_id is None:
+                try:
+                    profile = Profile.objects.get(user_dn=user_dn)
+                except (Profile.DoesNotExist, Profile.MultipleObjectsReturned):
+                    return None
+                user_id = profile.user_id
+                if user_id is None:
+                    return None
+                dn_cache.set(user_dn, user_id)
+            user = self.get_user(user_id)
+            if user and user.is_active:
+                return user
         return None
 
     def get_user(self, user_id):
-        m = get_user_model()
-        try:
-            return m.objects.get(pk=user_id)
-        except m.DoesNotExist:
-            return None
+        user = user_cache.get(user_id)
+        if user is None:
+            m = get_user_model()
+            try:
+                user = m.objects.select_related('profile').get(pk=user_id)
+            except m.DoesNotExist:
+                return None
+            user_cache.set(user_id, user)
+        # callers may modify the user, never hand out the cached instance
+        return copy.deepcopy(user)
+
+
+def _session_user(session):
+    try:
+        user_id = session[SESSION_KEY]
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return None
+    # sessions of backends removed from the settings are not valid
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return None
+    backend = load_backend(backend_path)
+    if isinstance(backend, X509Backend):
+        return backend.get_user(user_id)
+    # ModelBackend and LDAPBackend only look the user up by pk, the
+    # LDAP attributes are fetched when the LDAPBackend needs them
+    m = get_user_model()
+    try:
+        return m.objects.select_related('profile').get(pk=user_id)
+    except m.DoesNotExist:
+        return None
+
+
+def get_request_user(request):
+    """
+    The user of the session with its profile, loaded at most once per
+    request, see cloud_profiles.middleware.AuthenticationMiddleware
+    """
+    if not hasattr(request, '_cached_user'):
+        request._cached_user = _session_user(request.session) or \
+            AnonymousUser()
+    return request._cached_user
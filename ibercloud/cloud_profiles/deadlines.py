@@ -0,0 +1,29 @@
+#
+# Time budget of the request being served by the current thread
+#
+
+import threading
+import time
+
+_local = threading.local()
+
+
+def start(budget):
+    """
+    Gives the calls made from now on by this thread `budget` seconds
+    """
+    _local.deadline = time.time() + budget
+
+
+def clear():
+    _local.deadline = None
+
+
+def remaining():
+    """
+    Seconds left of the budget, or None if there is no budget
+    """
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.time()
@@ -0,0 +1,137 @@
+#
+# Streaming CSV and LDIF exports of the profiles and directory accounts
+#
+
+import csv
+from cStringIO import StringIO
+
+import ldif
+
+from cloud_profiles import ldap_users
+from cloud_profiles.models import DirectoryAccount, Profile
+from cloud_profiles.utils import chunked
+
+PROFILE_FIELDS = ['id', 'email', 'name', 'phone', 'institution', 'country',
+                  'status', 'user_dn', 'research_area', 'description',
+                  'resources', 'ldap_dn', 'uid_number']
+ACCOUNT_FIELDS = ['dn', 'email', 'name', 'uid_number', 'status']
+
+FORMATS = ('csv', 'ldif')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ldif': 'text/x-ldif; charset=utf-8',
+}
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def iter_profiles(filters=None, chunk_size=1000):
+    """
+    Yields the profiles as dicts of PROFILE_FIELDS, reading them in
+    chunks of pk ranges, each joined with the mirror of the directory
+    accounts in one query
+    """
+    fields = [f for f in PROFILE_FIELDS if f not in ('ldap_dn',
+                                                     'uid_number')]
+    qs = Profile.objects.filter(**(filters or {})).order_by('pk')
+    last = 0
+    while True:
+        chunk = list(qs.filter(pk__gt=last).values(*fields)[:chunk_size])
+        if not chunk:
+            break
+        last = chunk[-1]['id']
+        accounts = DirectoryAccount.objects.filter(
+            email__in=[p['email'] for p in chunk])
+        accounts = dict((a['email'], a) for a in
+                        accounts.values('email', 'dn', 'uid_number'))
+        for p in chunk:
+            account = accounts.get(p['email'], {})
+            p['ldap_dn'] = account.get('dn')
+            p['uid_number'] = account.get('uid_number')
+            yield p
+
+
+def iter_accounts(chunk_size=1000):
+    """
+    Yields the accounts of the directory, read with a paged search, as
+    dicts of ACCOUNT_FIELDS with the status of their profile
+    """
+    for chunk in chunked(ldap_users.iter_users(), chunk_size):
+        statuses = Profile.objects.filter(
+            email__in=[u['email'] for u in chunk])
+        statuses = dict(statuses.values_list('email', 'status'))
+        for u in chunk:
+            u['status'] = statuses.get(u['email'], Profile.EXTERNAL)
+            yield u
+
+
+def csv_lines(rows, fields):
+    """
+    Yields the header and then a CSV line for each row
+    """
+    out = StringIO()
+    writer = csv.writer(out)
+
+    def line(values):
+        writer.writerow(values)
+        value = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return value
+
+    yield line(fields)
+    for row in rows:
+        yield line([_encode(row[f]) for f in fields])
+
+
+def _profile_entry(p):
+    entry = {'uid': p['email'],
+             'cn': p['name'],
+             'telephoneNumber': p['phone'],
+             'o': p['institution'],
+             'c': p['country'],
+             'uidNumber': p['uid_number']}
+    # profiles without account get the dn they would be created with
+    dn = p['ldap_dn'] or Profile(email=p['email'],
+                                 country=p['country']).get_dn()
+    return dn, entry
+
+
+def _account_entry(u):
+    return u['dn'], {'uid': u['email'], 'cn': u['name'],
+                     'uidNumber': u['uid_number']}
+
+
+def ldif_records(rows, entry):
+    """
+    Yields an LDIF record for each row, `entry` returns the dn and the
+    attributes of a row
+    """
+    out = StringIO()
+    writer = ldif.LDIFWriter(out)
+    for row in rows:
+        dn, attrs = entry(row)
+        writer.unparse(_encode(dn),
+                       dict((k, [_encode(v)]) for k, v in attrs.items()
+                            if v not in (None, '')))
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+
+def export_profiles(fmt, filters=None):
+    if fmt == 'ldif':
+        return ldif_records(iter_profiles(filters), _profile_entry)
+    return csv_lines(iter_profiles(filters), PROFILE_FIELDS)
+
+
+def export_accounts(fmt):
+    if fmt == 'ldif':
+        return ldif_records(iter_accounts(), _account_entry)
+    return csv_lines(iter_accounts(), ACCOUNT_FIELDS)
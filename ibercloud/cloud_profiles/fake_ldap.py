@@ -0,0 +1,359 @@
+#
+# In process stand-in for the LDAP server, for tests and benchmarks.
+#
+# Set CLOUD_PROFILES_LDAP_INITIALIZE = 'cloud_profiles.fake_ldap.initialize'
+# to make ldap_users use it instead of python-ldap's initialize.
+#
+
+import base64
+import fnmatch
+import hashlib
+import itertools
+import threading
+import time
+
+import ldap
+from ldap.controls import SimplePagedResultsControl
+from django.conf import settings
+
+OPERATIONAL_ATTRS = ('createtimestamp', 'modifytimestamp')
+
+
+def _error(cls, desc):
+    return cls({'desc': desc})
+
+
+def _timestamp():
+    return time.strftime('%Y%m%d%H%M%SZ', time.gmtime())
+
+
+def _check_password(stored, passwd):
+    if stored.startswith('{SSHA}'):
+        raw = base64.b64decode(stored[6:])
+        digest, salt = raw[:20], raw[20:]
+        return hashlib.sha1(passwd + salt).digest() == digest
+    return stored == passwd
+
+
+def _values(value):
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+class Filter(object):
+    """
+    Parses and evaluates the subset of RFC 4515 search filters used by the
+    portal: &, |, !, equality with * wildcards, presence, >= and <=.
+    """
+
+    def __init__(self, filterstr):
+        self.filterstr = filterstr
+        self.tree, pos = self._parse(filterstr.strip(), 0)
+        if pos != len(filterstr.strip()):
+            raise _error(ldap.FILTER_ERROR, 'Bad search filter')
+
+    def _parse(self, s, pos):
+        if s[pos] != '(':
+            raise _error(ldap.FILTER_ERROR, 'Bad search filter')
+        pos += 1
+        if s[pos] in '&|':
+            op, children = s[pos], []
+            pos += 1
+            while s[pos] == '(':
+                child, pos = self._parse(s, pos)
+                children.append(child)
+            node = (op, children)
+        elif s[pos] == '!':
+            child, pos = self._parse(s, pos + 1)
+            node = ('!', child)
+        else:
+            end = s.index(')', pos)
+            item = s[pos:end]
+            for op in ('>=', '<=', '='):
+                if op in item:
+                    attr, value = item.split(op, 1)
+                    break
+            else:
+                raise _error(ldap.FILTER_ERROR, 'Bad search filter')
+            node = (op, (attr.strip().lower(), value))
+            pos = end
+        if s[pos] != ')':
+            raise _error(ldap.FILTER_ERROR, 'Bad search filter')
+        return node, pos + 1
+
+    def match(self, attrs, node=None):
+        op, arg = node or self.tree
+        if op == '&':
+            return all(self.match(attrs, n) for n in arg)
+        if op == '|':
+            return any(self.match(attrs, n) for n in arg)
+        if op == '!':
+            return not self.match(attrs, arg)
+        attr, value = arg
+        values = [v.lower() for v in attrs.get(attr, [])]
+        value = value.lower()
+        if op == '>=':
+            return any(v >= value for v in values)
+        if op == '<=':
+            return any(v <= value for v in values)
+        if value == '*':
+            return bool(values)
+        return any(fnmatch.fnmatchcase(v, value) for v in values)
+
+
+class FakeDirectory(object):
+    """
+    Entries of the fake server, shared by all its connections.
+
+    `latency` is the time in seconds every operation takes, either a
+    number or a dict with the 'bind', 'search', 'add', 'modify' and
+    'delete' keys. `sizelimit` limits the entries returned by searches
+    without the paged results control. Connections to the URIs in `down`
+    fail as if the server could not be contacted. Operations that would
+    take longer than the timeout of the connection fail with TIMEOUT.
+    """
+
+    def __init__(self, latency=0, sizelimit=0):
+        self.latency = latency
+        self.sizelimit = sizelimit
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.entries = {}
+            self.down = set()
+            self.ops = dict((op, 0) for op in ('bind', 'search', 'add',
+                                               'modify', 'delete'))
+
+    def credentials(self):
+        # the service accounts configured for the portal
+        return [(getattr(settings, 'CLOUD_PROFILES_LDAP_BIND_DN', None),
+                 getattr(settings, 'CLOUD_PROFILES_LDAP_BIND_PASSWORD', None)),
+                (getattr(settings, 'AUTH_LDAP_BIND_DN', None),
+                 getattr(settings, 'AUTH_LDAP_BIND_PASSWORD', None))]
+
+    def wait(self, op, timeout=None):
+        with self._lock:
+            self.ops[op] += 1
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(op, 0)
+        if timeout is not None and timeout >= 0 and latency > timeout:
+            time.sleep(timeout)
+            raise _error(ldap.TIMEOUT, 'Timed out')
+        if latency:
+            time.sleep(latency)
+
+    def bind(self, dn, passwd, timeout=None):
+        self.wait('bind', timeout)
+        with self._lock:
+            entry = self.entries.get(dn.lower())
+        if entry is not None:
+            if passwd and any(_check_password(v, passwd)
+                              for v in entry.get('userpassword', [])):
+                return
+        elif (dn, passwd) in self.credentials():
+            return
+        raise _error(ldap.INVALID_CREDENTIALS, 'Invalid credentials')
+
+    def search(self, base, scope, filterstr, attrlist, timeout=None):
+        self.wait('search', timeout)
+        flt = Filter(filterstr or '(objectClass=*)')
+        base = base.lower()
+        if attrlist:
+            attrlist = [a.lower() for a in attrlist]
+        results = []
+        with self._lock:
+            entries = sorted(self.entries.values(), key=lambda e: e['_dn'])
+        for entry in entries:
+            dn = entry['_dn'].lower()
+            if scope == ldap.SCOPE_BASE:
+                if dn != base:
+                    continue
+            elif base:
+                if not dn.endswith(',' + base):
+                    continue
+                if (scope == ldap.SCOPE_ONELEVEL and
+                        dn[:-len(base) - 1].count(',') != 0):
+                    continue
+            if not flt.match(entry):
+                continue
+            attrs = dict((a, list(v)) for a, v in entry.items()
+                         if not a.startswith('_') and
+                         (a in attrlist if attrlist else
+                          a not in OPERATIONAL_ATTRS))
+            results.append((entry['_dn'], attrs))
+        return results
+
+    def add(self, dn, modlist, timeout=None):
+        self.wait('add', timeout)
+        entry = {'_dn': dn}
+        for attr, value in modlist:
+            entry[attr.lower()] = _values(value)
+        entry['createtimestamp'] = entry['modifytimestamp'] = [_timestamp()]
+        with self._lock:
+            if dn.lower() in self.entries:
+                raise _error(ldap.ALREADY_EXISTS, 'Already exists')
+            self.entries[dn.lower()] = entry
+
+    def modify(self, dn, modlist, timeout=None):
+        self.wait('modify', timeout)
+        with self._lock:
+            entry = self.entries.get(dn.lower())
+            if entry is None:
+                raise _error(ldap.NO_SUCH_OBJECT, 'No such object')
+            for op, attr, value in modlist:
+                attr = attr.lower()
+                if op == ldap.MOD_DELETE:
+                    if value is None:
+                        entry.pop(attr, None)
+                    else:
+                        entry[attr] = [v for v in entry.get(attr, [])
+                                       if v not in _values(value)]
+                elif op == ldap.MOD_ADD:
+                    entry.setdefault(attr, []).extend(_values(value))
+                else:
+                    entry[attr] = _values(value)
+            entry['modifytimestamp'] = [_timestamp()]
+
+    def delete(self, dn, timeout=None):
+        self.wait('delete', timeout)
+        with self._lock:
+            if self.entries.pop(dn.lower(), None) is None:
+                raise _error(ldap.NO_SUCH_OBJECT, 'No such object')
+
+
+class FakeLDAPObject(object):
+    """
+    Implements the part of python-ldap's LDAPObject used by ldap_users
+    """
+
+    _msgids = itertools.count(1)
+
+    def __init__(self, uri, directory):
+        self.uri = uri
+        self.directory = directory
+        self.bound_dn = None
+        self.options = {}
+        self._results = {}
+
+    def _check_bound(self):
+        if self.bound_dn is None or self.uri in self.directory.down:
+            raise _error(ldap.SERVER_DOWN, "Can't contact LDAP server")
+
+    def _async(self, func, *args):
+        msgid = next(self._msgids)
+        try:
+            self._results[msgid] = (func(*args), None)
+        except ldap.LDAPError as e:
+            self._results[msgid] = (None, e)
+        return msgid
+
+    def _pop_result(self, msgid):
+        try:
+            value, error = self._results.pop(msgid)
+        except KeyError:
+            raise _error(ldap.NO_SUCH_OPERATION, 'No such operation')
+        if error is not None:
+            raise error
+        return value
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def _timeout(self, *options):
+        timeouts = [self.options[o] for o in options or (ldap.OPT_TIMEOUT,)
+                    if self.options.get(o) is not None]
+        return min(timeouts) if timeouts else None
+
+    def simple_bind_s(self, who='', cred=''):
+        if self.uri in self.directory.down:
+            raise _error(ldap.SERVER_DOWN, "Can't contact LDAP server")
+        self.directory.bind(who, cred, self._timeout(ldap.OPT_NETWORK_TIMEOUT,
+                                                     ldap.OPT_TIMEOUT))
+        self.bound_dn = who
+
+    def whoami_s(self):
+        self._check_bound()
+        return 'dn:%s' % self.bound_dn
+
+    def unbind_s(self):
+        self.bound_dn = None
+
+    def search_s(self, base, scope, filterstr=None, attrlist=None,
+                 attrsonly=0):
+        self._check_bound()
+        results = self.directory.search(base, scope, filterstr, attrlist,
+                                        self._timeout())
+        limit = self.directory.sizelimit
+        if limit and len(results) > limit:
+            raise _error(ldap.SIZELIMIT_EXCEEDED, 'Size limit exceeded')
+        return results
+
+    def search_ext(self, base, scope, filterstr=None, attrlist=None,
+                   attrsonly=0, serverctrls=None, clientctrls=None,
+                   timeout=-1, sizelimit=0):
+        self._check_bound()
+        page = None
+        for ctrl in serverctrls or []:
+            if ctrl.controlType == SimplePagedResultsControl.controlType:
+                page = ctrl
+        if page is None:
+            return self._async(self.search_s, base, scope, filterstr,
+                               attrlist)
+
+        def paged_search():
+            results = self.directory.search(base, scope, filterstr,
+                                            attrlist, self._timeout())
+            start = int(page.cookie or 0)
+            end = start + page.size
+            cookie = str(end) if end < len(results) else ''
+            ctrl = SimplePagedResultsControl(True, size=0, cookie=cookie)
+            return results[start:end], [ctrl]
+        return self._async(paged_search)
+
+    def result3(self, msgid=-1, all=1, timeout=None):
+        value = self._pop_result(msgid)
+        if isinstance(value, tuple):
+            rdata, ctrls = value
+        else:
+            rdata, ctrls = value, []
+        return ldap.RES_SEARCH_RESULT, rdata, msgid, ctrls
+
+    def result(self, msgid=-1, all=1, timeout=None):
+        value = self._pop_result(msgid)
+        if isinstance(value, tuple):
+            value = value[0]
+        return ldap.RES_SEARCH_RESULT, value or []
+
+    def add(self, dn, modlist):
+        self._check_bound()
+        return self._async(self.directory.add, dn, modlist, self._timeout())
+
+    def add_s(self, dn, modlist):
+        self._pop_result(self.add(dn, modlist))
+
+    def modify(self, dn, modlist):
+        self._check_bound()
+        return self._async(self.directory.modify, dn, modlist,
+                           self._timeout())
+
+    def modify_s(self, dn, modlist):
+        self._pop_result(self.modify(dn, modlist))
+
+    def delete(self, dn):
+        self._check_bound()
+        return self._async(self.directory.delete, dn, self._timeout())
+
+    def delete_s(self, dn):
+        self._pop_result(self.delete(dn))
+
+
+# the directory used by initialize
+directory = FakeDirectory()
+
+
+def initialize(uri):
+    return FakeLDAPObject(uri, directory)
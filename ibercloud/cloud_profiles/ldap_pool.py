@@ -0,0 +1,148 @@
+#
+# Bounded pool of bound LDAP connections
+#
+
+import threading
+import time
+from contextlib import contextmanager
+
+import ldap
+
+# errors after which a connection can not be trusted anymore
+BROKEN_CONN_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR)
+
+
+class PoolExhausted(ldap.LDAPError):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to `size` connections bound as `bind_dn` against `server`.
+
+    Idle connections older than `idle_timeout` are dropped and reopened,
+    connections idle for more than `check_interval` are checked with a
+    whoami before being handed out.
+    """
+
+    def __init__(self, server, bind_dn, passwd, connect, size=4,
+                 idle_timeout=300, check_interval=30, wait_timeout=10):
+        self.server = server
+        self.bind_dn = bind_dn
+        self.passwd = passwd
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self._connect = connect
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'expired': 0,
+            'health_failures': 0,
+            'waits': 0,
+        }
+
+    def _open(self):
+        conn = self._connect(self.server, self.bind_dn, self.passwd)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _healthy(self, conn, idle_for):
+        if idle_for < self.check_interval:
+            return True
+        try:
+            conn.whoami_s()
+            return True
+        except ldap.LDAPError:
+            with self._cond:
+                self._stats['health_failures'] += 1
+            return False
+
+    def acquire(self):
+        deadline = time.time() + self.wait_timeout
+        with self._cond:
+            while not self._idle and self._in_use >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhausted({'desc': 'LDAP connection pool '
+                                                 'exhausted for %s' %
+                                                 self.server})
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+            self._in_use += 1
+            idle = self._idle.pop() if self._idle else None
+        try:
+            while idle:
+                conn, last_used = idle
+                idle_for = time.time() - last_used
+                if idle_for > self.idle_timeout:
+                    with self._cond:
+                        self._stats['expired'] += 1
+                    self._close(conn)
+                elif self._healthy(conn, idle_for):
+                    with self._cond:
+                        self._stats['reused'] += 1
+                    return conn
+                else:
+                    self._close(conn)
+                with self._cond:
+                    idle = self._idle.pop() if self._idle else None
+            return self._open()
+        except:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._stats['discarded'] += 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+        if discard:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except BROKEN_CONN_ERRORS:
+            self.release(conn, discard=True)
+            raise
+        except:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, last_used in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({'server': self.server,
+                          'bind_dn': self.bind_dn,
+                          'size': self.size,
+                          'in_use': self._in_use,
+                          'idle': len(self._idle)})
+        return stats
@@ -0,0 +1,191 @@
+#
+# Selection of the directory server for each LDAP operation
+#
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import ldap
+
+MASTER = 'master'
+REPLICA = 'replica'
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(ldap.SERVER_DOWN):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Opens once `error_rate` of the last `window` calls (and at least
+    `min_calls` of them) failed, and stays open for `cooldown` seconds.
+    After that calls are let through again: the first success closes
+    the breaker, a failure opens it for another cooldown.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, window=20, min_calls=5, error_rate=0.5, cooldown=30):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.opens = 0
+
+    def state(self, now=None):
+        if self.opened_at is None:
+            return self.CLOSED
+        if (now or time.time()) - self.opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allows(self, now=None):
+        return self.state(now) != self.OPEN
+
+    def _open(self, now):
+        self.opened_at = now
+        self.opens += 1
+        self.outcomes.clear()
+
+    def record(self, ok, now=None):
+        now = now or time.time()
+        if self.opened_at is not None:
+            if ok:
+                self.opened_at = None
+            else:
+                self._open(now)
+            return
+        self.outcomes.append(ok)
+        calls = len(self.outcomes)
+        failures = calls - sum(self.outcomes)
+        if calls >= self.min_calls and failures >= self.error_rate * calls:
+            self._open(now)
+
+    def stats(self, now=None):
+        calls = len(self.outcomes)
+        return {'state': self.state(now),
+                'error_rate': (calls - sum(self.outcomes)) / float(calls)
+                              if calls else 0.0,
+                'opens': self.opens}
+
+
+class Server(object):
+    """
+    A directory server and what is known about its health: the moving
+    average of its operation latency and the breaker of its failures.
+    """
+
+    def __init__(self, uri, role=REPLICA, breaker=None):
+        self.uri = uri
+        self.role = role
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = None
+        self.timeouts = 0
+
+    def __repr__(self):
+        return '<Server %s (%s)>' % (self.uri, self.role)
+
+
+class ServerSet(object):
+    """
+    Writes go to the master, reads are spread over the replicas,
+    preferring the faster ones, with the master as last resort.
+
+    Failed calls, and calls slower than `slow_threshold` seconds, count
+    as errors for the breaker of the server. Servers with an open
+    breaker are skipped, and when every candidate is skipped the call
+    fails at once with CircuitOpen.
+    """
+
+    def __init__(self, servers, window=20, min_calls=5, error_rate=0.5,
+                 cooldown=30, slow_threshold=5.0, alpha=0.3):
+        self.servers = [Server(s['uri'], s.get('role', REPLICA),
+                               CircuitBreaker(window, min_calls, error_rate,
+                                              cooldown))
+                        for s in servers]
+        if not any(s.role == MASTER for s in self.servers):
+            raise ValueError('No master LDAP server configured')
+        self.slow_threshold = slow_threshold
+        self.alpha = alpha
+        self._lock = threading.Lock()
+
+    def _pick(self, servers):
+        # best of two random choices, so that load is spread over the
+        # replicas and the slow ones get less of it
+        if len(servers) < 2:
+            return servers[0]
+        a, b = random.sample(servers, 2)
+        return a if (a.latency or 0) <= (b.latency or 0) else b
+
+    def candidates(self, write=True):
+        now = time.time()
+        with self._lock:
+            up = [s for s in self.servers if s.breaker.allows(now) and
+                  (s.role == MASTER or not write)]
+            replicas = [s for s in up if s.role != MASTER]
+            ordered = []
+            if replicas:
+                first = self._pick(replicas)
+                ordered.append(first)
+                replicas.remove(first)
+                ordered.extend(sorted(replicas,
+                                      key=lambda s: s.latency or 0))
+            ordered.extend(s for s in up if s.role == MASTER)
+        if not ordered:
+            raise CircuitOpen({'desc': 'No %sLDAP server available' %
+                                       ('master ' if write else '')})
+        return ordered
+
+    def record(self, server, elapsed, error=None):
+        """
+        Accounts a call to `server`, `error` is set if it failed in a way
+        that says something about the server health
+        """
+        with self._lock:
+            if server.latency is None:
+                server.latency = elapsed
+            else:
+                server.latency = (self.alpha * elapsed +
+                                  (1 - self.alpha) * server.latency)
+            if isinstance(error, ldap.TIMEOUT):
+                server.timeouts += 1
+            opened_at = server.breaker.opened_at
+            server.breaker.record(error is None and
+                                  elapsed <= self.slow_threshold)
+            if server.breaker.opened_at is None:
+                if opened_at is not None:
+                    logger.info('LDAP server %s is back', server.uri)
+            elif opened_at is None:
+                logger.warning('LDAP server %s ejected for %ss: %s',
+                               server.uri, server.breaker.cooldown,
+                               error or 'too slow')
+
+    def reset(self):
+        with self._lock:
+            for s in self.servers:
+                b = s.breaker
+                s.breaker = CircuitBreaker(b.outcomes.maxlen, b.min_calls,
+                                           b.error_rate, b.cooldown)
+                s.latency = None
+                s.timeouts = 0
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            stats = []
+            for s in self.servers:
+                st = s.breaker.stats(now)
+                st.update({'uri': s.uri,
+                           'role': s.role,
+                           'latency': s.latency,
+                           'timeouts': s.timeouts})
+                stats.append(st)
+            return stats
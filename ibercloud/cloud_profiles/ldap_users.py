@@ -1,85 +1,505 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
 import ldap
 import ldap.modlist as modlist
+from ldap.controls import SimplePagedResultsControl
 from django.conf import settings
 from django.contrib.auth.hashers import make_password
+from django.utils.importlib import import_module
 
+from cloud_profiles import deadlines, metrics, timing
+from cloud_profiles.ldap_pool import ConnectionPool, BROKEN_CONN_ERRORS
+from cloud_profiles.ldap_servers import ServerSet, Server, MASTER
 
-def get_ldap_conn(server=None, bind_dn=None, passwd=None):
-    # Options
+_pools = {}
+_pools_lock = threading.Lock()
+_servers = None
+_servers_config = None
+_deadlines_exceeded = 0
+_options_set = False
+
+USER_ATTRS = ['cn', 'uid', 'uidNumber', 'modifyTimestamp']
+
+
+def set_ldap_options():
+    global _options_set
+    if _options_set:
+        return
     opts = getattr(settings, 'CLOUD_PROFILES_LDAP_OPTIONS', {})
     for opt in opts.items():
         ldap.set_option(opt[0], opt[1])
+    _options_set = True
+
+
+def ldap_initialize(server):
+    # CLOUD_PROFILES_LDAP_INITIALIZE replaces ldap.initialize, e.g. with
+    # the in process server of cloud_profiles.fake_ldap
+    path = getattr(settings, 'CLOUD_PROFILES_LDAP_INITIALIZE', None)
+    if not path:
+        return ldap.initialize(server)
+    module, func = path.rsplit('.', 1)
+    return getattr(import_module(module), func)(server)
+
+
+def get_servers():
+    """
+    Returns the ServerSet of CLOUD_PROFILES_LDAP_SERVERS, a list of
+    {'uri': ..., 'role': 'master' | 'replica'} dicts, that defaults to
+    CLOUD_PROFILES_LDAP_SERVER_URI as the only master
+    """
+    global _servers, _servers_config
+    config = getattr(settings, 'CLOUD_PROFILES_LDAP_SERVERS', None)
+    if not config:
+        config = [{'uri': settings.CLOUD_PROFILES_LDAP_SERVER_URI,
+                   'role': MASTER}]
+    config = (tuple(sorted(s.items())) for s in config)
+    config = (tuple(config),
+              getattr(settings, 'CLOUD_PROFILES_LDAP_BREAKER_WINDOW', 20),
+              getattr(settings, 'CLOUD_PROFILES_LDAP_BREAKER_MIN_CALLS', 5),
+              getattr(settings, 'CLOUD_PROFILES_LDAP_BREAKER_ERROR_RATE',
+                      0.5),
+              getattr(settings, 'CLOUD_PROFILES_LDAP_COOLDOWN', 30),
+              getattr(settings, 'CLOUD_PROFILES_LDAP_SLOW_THRESHOLD', 5.0))
+    with _pools_lock:
+        if _servers is None or _servers_config != config:
+            servers, window, min_calls, error_rate, cooldown, slow = config
+            _servers = ServerSet([dict(s) for s in servers], window=window,
+                                 min_calls=min_calls, error_rate=error_rate,
+                                 cooldown=cooldown, slow_threshold=slow)
+            _servers_config = config
+        return _servers
+
+
+class DeadlineExceeded(ldap.TIMEOUT):
+    pass
+
+
+def operation_timeout():
+    """
+    Seconds the next LDAP call may take: CLOUD_PROFILES_LDAP_TIMEOUT, or
+    what is left of the request budget (see deadlines) if that is less
+    """
+    global _deadlines_exceeded
+    timeout = getattr(settings, 'CLOUD_PROFILES_LDAP_TIMEOUT', 5)
+    left = deadlines.remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        with _pools_lock:
+            _deadlines_exceeded += 1
+        raise DeadlineExceeded({'desc': 'Request deadline exceeded'})
+    return min(timeout, left)
+
+
+def get_ldap_conn(server=None, bind_dn=None, passwd=None):
+    set_ldap_options()
     if not server:
-        server = settings.CLOUD_PROFILES_LDAP_SERVER_URI
+        server = get_servers().candidates(write=True)[0].uri
     if not bind_dn:
         bind_dn = settings.CLOUD_PROFILES_LDAP_BIND_DN
     if not passwd:
         passwd = settings.CLOUD_PROFILES_LDAP_BIND_PASSWORD
-    conn = ldap.initialize(server)
-    conn.simple_bind_s(bind_dn, passwd)
+    timeout = operation_timeout()
+    conn = ldap_initialize(server)
+    conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+    conn.set_option(ldap.OPT_TIMEOUT, timeout)
+    try:
+        conn.simple_bind_s(bind_dn, passwd)
+    except:
+        conn.unbind_s()
+        raise
     return conn
 
 
-def get_users():
-    # This requires the general auth bind dn
-    conn = get_ldap_conn(bind_dn=settings.AUTH_LDAP_BIND_DN,
-                         passwd=settings.AUTH_LDAP_BIND_PASSWORD)
+def get_pool(server, bind_dn, passwd):
+    key = (server, bind_dn)
+    size = getattr(settings, 'CLOUD_PROFILES_LDAP_POOL_SIZE', 4)
+    idle_timeout = getattr(settings, 'CLOUD_PROFILES_LDAP_POOL_IDLE_TIMEOUT',
+                           300)
+    check_interval = getattr(settings,
+                             'CLOUD_PROFILES_LDAP_POOL_CHECK_INTERVAL', 30)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None or pool.passwd != passwd:
+            if pool is not None:
+                pool.close()
+            pool = ConnectionPool(server, bind_dn, passwd, get_ldap_conn,
+                                  size=size, idle_timeout=idle_timeout,
+                                  check_interval=check_interval)
+            _pools[key] = pool
+        return pool
+
+
+# python-ldap method -> operation type of the latency metric
+OPERATION_TYPES = {
+    'simple_bind_s': 'bind',
+    'search_s': 'search',
+    'search_ext': 'search',
+    'result': 'result',
+    'result3': 'result',
+    'add': 'add',
+    'add_s': 'add',
+    'modify': 'modify',
+    'modify_s': 'modify',
+    'delete': 'delete',
+    'delete_s': 'delete',
+    'whoami_s': 'whoami',
+}
+
+
+def _record_time(op, elapsed):
+    timing.record('ldap', elapsed)
+    metrics.observe('ibercloud_ldap_operation_seconds', elapsed, op=op)
+
+
+class TimedConnection(object):
+    """
+    Wraps a connection to limit each of its calls to operation_timeout()
+    and to report their time and outcome to the ServerSet, so slow or
+    failing servers get ejected
+    """
+
+    def __init__(self, conn, server, servers):
+        self._conn = conn
+        self._server = server
+        self._servers = servers
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            timeout = operation_timeout()
+            self._conn.set_option(ldap.OPT_TIMEOUT, timeout)
+            if name in ('result', 'result3'):
+                kwargs.setdefault('timeout', timeout)
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except BROKEN_CONN_ERRORS as e:
+                self._servers.record(self._server, time.time() - start, e)
+                raise
+            finally:
+                _record_time(OPERATION_TYPES.get(name, name),
+                             time.time() - start)
+            self._servers.record(self._server, time.time() - start)
+            return result
+        return timed
+
+
+def _connect(server, bind_dn, passwd, pooled):
+    if pooled:
+        pool = get_pool(server, bind_dn, passwd)
+        return pool.acquire(), pool
+    return get_ldap_conn(server, bind_dn, passwd), None
+
+
+def _disconnect(conn, pool, discard=False):
+    if pool is not None:
+        pool.release(conn, discard)
+        return
+    try:
+        conn.unbind_s()
+    except ldap.LDAPError:
+        pass
+
+
+@contextmanager
+def ldap_connection(server=None, bind_dn=None, passwd=None, pooled=True,
+                    write=True):
+    """
+    Yields a bound connection, from the pool of (server, bind_dn) if
+    pooled, or a fresh one that is unbound afterwards otherwise.
+    Binds with end user credentials must not be pooled, as a reused
+    connection would not check the password again.
+
+    Without `server` the connection goes to the master for writes and to
+    one of the replicas otherwise, failing over to the next candidate of
+    get_servers() when a server can not be reached.
+    """
+    if not bind_dn:
+        bind_dn = settings.CLOUD_PROFILES_LDAP_BIND_DN
+    if not passwd:
+        passwd = settings.CLOUD_PROFILES_LDAP_BIND_PASSWORD
+    servers = get_servers()
+    if server:
+        candidates = [Server(server, MASTER)]
+    else:
+        candidates = servers.candidates(write)
+    for candidate in candidates:
+        start = time.time()
+        try:
+            conn, pool = _connect(candidate.uri, bind_dn, passwd, pooled)
+            break
+        except DeadlineExceeded:
+            raise
+        except BROKEN_CONN_ERRORS as e:
+            servers.record(candidate, time.time() - start, e)
+            error = e
+        finally:
+            _record_time('connect', time.time() - start)
+    else:
+        raise error
+    try:
+        yield TimedConnection(conn, candidate, servers)
+    except DeadlineExceeded:
+        # raised before the call, the connection is fine
+        _disconnect(conn, pool)
+        raise
+    except BROKEN_CONN_ERRORS:
+        _disconnect(conn, pool, discard=True)
+        raise
+    except:
+        _disconnect(conn, pool)
+        raise
+    else:
+        _disconnect(conn, pool)
+
+
+def server_stats():
+    return get_servers().stats()
+
+
+def deadline_stats():
+    with _pools_lock:
+        return {'exceeded': _deadlines_exceeded}
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [p.stats() for p in pools]
+
+
+def iter_users(page_size=None, since=None):
+    """
+    Yields the directory accounts as dicts, fetching them in pages with
+    the Simple Paged Results control (RFC 2696) so large directories do
+    not hit the server sizelimit. With `since`, a generalized time string,
+    only the accounts modified from then on are returned.
+    """
     base = getattr(settings, 'CLOUD_PROFILES_LDAP_BASE_DN',
                    'o=cloud,dc=ibergrid,dc=eu')
     account_filter = getattr(settings, 'CLOUD_PROFILES_LDAP_OBJ_CLASS',
                              '(objectClass=account)')
-    user_list = conn.search_s(base, ldap.SCOPE_SUBTREE, account_filter, 
-                              ['cn','uid'])    
-    return [{'email': u[1]['uid'][0],
-             'name': u[1]['cn'][0]} for u in user_list]
+    if since is not None:
+        account_filter = '(&%s(modifyTimestamp>=%s))' % (account_filter,
+                                                         since)
+    if not page_size:
+        page_size = getattr(settings, 'CLOUD_PROFILES_LDAP_PAGE_SIZE', 500)
+    page_ctrl = SimplePagedResultsControl(True, size=page_size, cookie='')
+    # This requires the general auth bind dn
+    with ldap_connection(bind_dn=settings.AUTH_LDAP_BIND_DN,
+                         passwd=settings.AUTH_LDAP_BIND_PASSWORD,
+                         write=False) as conn:
+        while True:
+            msgid = conn.search_ext(base, ldap.SCOPE_SUBTREE, account_filter,
+                                    USER_ATTRS, serverctrls=[page_ctrl])
+            rtype, rdata, rmsgid, serverctrls = conn.result3(msgid)
+            for dn, attrs in rdata:
+                # skip search references
+                if dn is None:
+                    continue
+                yield _user_from_entry(dn, attrs)
+            cookie = None
+            for ctrl in serverctrls:
+                if ctrl.controlType == SimplePagedResultsControl.controlType:
+                    cookie = ctrl.cookie
+            if not cookie:
+                break
+            page_ctrl.cookie = cookie
+
+
+def _user_from_entry(dn, attrs):
+    attrs = dict((k.lower(), v) for k, v in attrs.items())
+    uid_number = attrs.get('uidnumber')
+    return {'dn': dn,
+            'email': attrs['uid'][0],
+            'name': attrs['cn'][0],
+            'uid_number': int(uid_number[0]) if uid_number else None,
+            'modify_timestamp': attrs.get('modifytimestamp', [''])[0]}
+
+
+def _record_changes(removed_dns, new_users=()):
+    """
+    Applies the changes made by this module to the local mirror of the
+    directory
+    """
+    # models imports this module
+    from cloud_profiles.models import DirectoryAccount
+    DirectoryAccount.objects.record_changes(removed_dns, new_users)
+
+
+def error_message(error):
+    # python-ldap errors carry a dict with the description
+    try:
+        return error.args[0]['desc']
+    except (IndexError, KeyError, TypeError):
+        return str(error)
 
 
 def check_user_password(dn, passwd):
     try:
-        get_ldap_conn(bind_dn=dn, passwd=str(passwd))
-        return True
+        with ldap_connection(bind_dn=dn, passwd=str(passwd), pooled=False,
+                             write=False):
+            return True
     except ldap.LDAPError:
         return False
 
 def reset_user_password(dn, password):
-    conn = get_ldap_conn()
     ldif = modlist.modifyModlist({'userpassword': 'fake'},
                                  {'userpassword': str(password)})
-    conn.modify_s(dn, ldif)
+    with ldap_connection() as conn:
+        conn.modify_s(dn, ldif)
 
 
 def change_user_password(dn, old_pwd, new_pwd):
-    conn = get_ldap_conn(bind_dn=dn, passwd=str(old_pwd))
     ldif = modlist.modifyModlist({'userpassword': str(old_pwd)},
                                  {'userpassword': str(new_pwd)})
-    conn.modify_s(dn, ldif)
+    with ldap_connection(bind_dn=dn, passwd=str(old_pwd),
+                         pooled=False) as conn:
+        conn.modify_s(dn, ldif)
 
 
 def delete_user(dn):
-    conn = get_ldap_conn()
-    conn.delete_s(dn)
+    with ldap_connection() as conn:
+        conn.delete_s(dn)
+    _record_changes([dn])
+
+
+def _user_info(email, name, uid):
+    return {'uid': email.encode('ascii', 'replace'),
+            'cn': name.encode('ascii', 'replace'),
+            'uidnumber': str(uid),
+            'gidnumber': str(uid),
+            'objectclass': ('account',
+                            'posixAccount',
+                            'top',
+                            'shadowAccount'),
+            'homedirectory': '/',
+            'shadowlastchange': '538',
+            'shadowmin': '0',
+            'shadowmax': '999999',
+            'shadowwarning': '22',
+            'shadowinactive': '15',
+            'shadowexpire': '-1',
+            'shadowflag': '0',
+            'userpassword': make_password(None).encode('ascii', 'ignore'),
+            }
+
+
+def _user_from_info(dn, user_info):
+    # the modify timestamp is only known by the server
+    return {'dn': dn,
+            'email': user_info['uid'],
+            'name': user_info['cn'],
+            'uid_number': int(user_info['uidnumber']),
+            'modify_timestamp': ''}
 
 
 def create_user(dn, email, name, uid):
-    conn = get_ldap_conn()
-    user_info = {'uid': email.encode('ascii', 'replace'),
-                 'cn': name.encode('ascii', 'replace'),
-                 'uidnumber': str(uid),
-                 'gidnumber': str(uid),
-                 'objectclass': ('account',
-                                 'posixAccount',
-                                 'top',
-                                 'shadowAccount'),
-                 'homedirectory': '/',
-                 'shadowlastchange': '538',
-                 'shadowmin': '0',
-                 'shadowmax': '999999',
-                 'shadowwarning': '22',
-                 'shadowinactive': '15',
-                 'shadowexpire': '-1',
-                 'shadowflag': '0',
-                 'userpassword': make_password(None).encode('ascii', 'ignore'),
-                 }
-    print user_info
+    user_info = _user_info(email, name, uid)
     ldif = modlist.addModlist(user_info)
-    conn.add_s(dn, ldif)
+    with ldap_connection() as conn:
+        conn.add_s(dn, ldif)
+    _record_changes([dn], [_user_from_info(dn, user_info)])
+
+
+# operations of apply_operations
+CREATE = 'create'
+DELETE = 'delete'
+RESET_PASSWORD = 'reset_password'
+
+# errors meaning that the operation was already applied
+_ALREADY_APPLIED = {
+    CREATE: ldap.ALREADY_EXISTS,
+    DELETE: ldap.NO_SUCH_OBJECT,
+}
+
+
+def hash_password(password):
+    """
+    Salted SHA1 in the userPassword format, so the clear text password
+    does not need to be stored before it is written to the directory
+    """
+    salt = os.urandom(8)
+    digest = hashlib.sha1(str(password) + salt).digest()
+    return '{SSHA}' + base64.b64encode(digest + salt)
+
+
+def _submit(conn, op, dn, data):
+    if op == CREATE:
+        info = _user_info(data['email'], data['name'], data['uid'])
+        return conn.add(dn, modlist.addModlist(info))
+    elif op == DELETE:
+        return conn.delete(dn)
+    elif op == RESET_PASSWORD:
+        return conn.modify(dn, [(ldap.MOD_REPLACE, 'userpassword',
+                                 str(data['password']))])
+    raise ValueError('Unknown directory operation %s' % op)
+
+
+def apply_operations(ops):
+    """
+    Applies a list of (op, dn, data) operations over one connection,
+    returning a list with None or the LDAPError raised for each of them.
+
+    Operations on different entries are sent together with the
+    asynchronous API, the ones on the same entry wait for the previous
+    to complete, and are skipped if it failed. Creating an existing entry
+    or deleting a missing one count as applied, so that the operations
+    can be retried.
+    """
+    not_run = object()
+    results = [not_run] * len(ops)
+    # final state of the entries created or deleted
+    changes = {}
+    pending = range(len(ops))
+    failed_dns = set()
+    try:
+        with ldap_connection() as conn:
+            while pending:
+                wave, rest, dns = [], [], set()
+                for i in pending:
+                    dn = ops[i][1].lower()
+                    if dn in failed_dns:
+                        results[i] = ldap.OTHER({'desc': 'A previous '
+                                                 'operation on the entry '
+                                                 'failed'})
+                    elif dn in dns:
+                        rest.append(i)
+                    else:
+                        dns.add(dn)
+                        wave.append(i)
+                msgids = [(i, _submit(conn, *ops[i])) for i in wave]
+                for i, msgid in msgids:
+                    op, dn, data = ops[i]
+                    try:
+                        conn.result(msgid)
+                    except BROKEN_CONN_ERRORS:
+                        raise
+                    except _ALREADY_APPLIED.get(op, ()):
+                        pass
+                    except ldap.LDAPError as e:
+                        results[i] = e
+                        failed_dns.add(dn.lower())
+                        continue
+                    results[i] = None
+                    if op == CREATE:
+                        info = _user_info(data['email'], data['name'],
+                                          data['uid'])
+                        changes[dn.lower()] = (dn, _user_from_info(dn, info))
+                    elif op == DELETE:
+                        changes[dn.lower()] = (dn, None)
+                pending = rest
+    except BROKEN_CONN_ERRORS as e:
+        results = [e if r is not_run else r for r in results]
+    _record_changes([dn for dn, user in changes.values()],
+                    [user for dn, user in changes.values() if user])
+    return results
@@ -0,0 +1,148 @@
+#
+# Outbound mail queue
+#
+
+import logging
+import smtplib
+import socket
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.utils import timezone
+
+from cloud_profiles import timing
+from cloud_profiles.models import QueuedMail
+from cloud_profiles.utils import chunked
+
+logger = logging.getLogger(__name__)
+
+# errors after which the SMTP connection is not usable anymore
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+def queue_mail(subject, body, from_email, recipients):
+    """
+    Stores the message for the send_queued_mail command, same arguments
+    as django.core.mail.send_mail
+    """
+    with timing.timed('mail'):
+        return QueuedMail.objects.create(subject=subject, body=body,
+                                         from_email=from_email,
+                                         recipients=','.join(recipients))
+
+
+def queue_mails(messages):
+    """
+    Stores several messages in one query, `messages` is a list of
+    (subject, body, from_email, recipients) tuples
+    """
+    with timing.timed('mail'):
+        QueuedMail.objects.bulk_create([
+            QueuedMail(subject=subject, body=body, from_email=from_email,
+                       recipients=','.join(recipients))
+            for subject, body, from_email, recipients in messages])
+
+
+def _retry_delay(attempts):
+    base = getattr(settings, 'CLOUD_PROFILES_MAIL_RETRY_DELAY', 60)
+    return timedelta(seconds=base * 2 ** (attempts - 1))
+
+
+def _recipient_errors(message, error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return dict((r, str(e)) for r, e in error.recipients.items())
+    return dict((r, str(error)) for r in message.recipients())
+
+
+def send_messages(messages, chunk_size=None):
+    """
+    Sends the already rendered EmailMessages over one SMTP connection per
+    chunk of `chunk_size` (CLOUD_PROFILES_MAIL_CHUNK_SIZE) messages.
+    Returns a list with, for each message, None if it was sent or a dict
+    of recipient -> error otherwise.
+    """
+    if not chunk_size:
+        chunk_size = getattr(settings, 'CLOUD_PROFILES_MAIL_CHUNK_SIZE', 50)
+    results = []
+    for chunk in chunked(messages, chunk_size):
+        connection = get_connection()
+        try:
+            with timing.timed('smtp'):
+                connection.open()
+        except (smtplib.SMTPException, socket.error) as e:
+            logger.warning('Unable to connect to the mail server: %s', e)
+            results.extend(_recipient_errors(m, e) for m in chunk)
+            continue
+        broken = None
+        for message in chunk:
+            if broken is not None:
+                # the rest of the chunk fails with the connection
+                results.append(_recipient_errors(message, broken))
+                continue
+            try:
+                with timing.timed('smtp'):
+                    connection.send_messages([message])
+                results.append(None)
+            except (smtplib.SMTPException, socket.error) as e:
+                results.append(_recipient_errors(message, e))
+                if isinstance(e, CONNECTION_ERRORS):
+                    broken = e
+        try:
+            connection.close()
+        except (smtplib.SMTPException, socket.error):
+            pass
+    return results
+
+
+def claim_queued_mail(batch_size=50):
+    """
+    Returns up to `batch_size` due messages, claimed so that other
+    send_queued_mail runs skip them. The claim moves next_attempt
+    CLOUD_PROFILES_MAIL_CLAIM_TIMEOUT seconds ahead with a conditional
+    update, the messages of a run that dies are sent after that.
+    """
+    max_attempts = getattr(settings, 'CLOUD_PROFILES_MAIL_MAX_ATTEMPTS', 8)
+    timeout = getattr(settings, 'CLOUD_PROFILES_MAIL_CLAIM_TIMEOUT', 600)
+    now = timezone.now()
+    due = QueuedMail.objects.filter(next_attempt__lte=now,
+                                    attempts__lt=max_attempts)
+    pks = list(due.order_by('next_attempt').values_list(
+        'pk', flat=True)[:batch_size])
+    if not pks:
+        return []
+    claim = uuid.uuid4().hex
+    # rows claimed meanwhile by another run are no longer due
+    due.filter(pk__in=pks).update(
+        claim=claim, next_attempt=now + timedelta(seconds=timeout))
+    return list(QueuedMail.objects.filter(claim=claim).order_by('pk'))
+
+
+def send_queued_mail(batch_size=50, chunk_size=None):
+    """
+    Sends the pending messages that are due with send_messages. Failed
+    messages are retried with exponential backoff up to
+    CLOUD_PROFILES_MAIL_MAX_ATTEMPTS times. Returns (sent, failed).
+    """
+    pending = claim_queued_mail(batch_size)
+    if not pending:
+        return 0, 0
+    results = send_messages([EmailMessage(m.subject, m.body, m.from_email,
+                                          m.get_recipients())
+                             for m in pending], chunk_size)
+    sent = []
+    for mail, errors in zip(pending, results):
+        if errors is None:
+            sent.append(mail.pk)
+            continue
+        mail.attempts += 1
+        mail.last_error = '; '.join('%s: %s' % item
+                                    for item in sorted(errors.items()))
+        mail.next_attempt = timezone.now() + _retry_delay(mail.attempts)
+        mail.claim = ''
+        mail.save()
+        logger.warning('Unable to send mail %s (attempt %d): %s',
+                       mail.pk, mail.attempts, mail.last_error)
+    QueuedMail.objects.filter(pk__in=sent).delete()
+    return len(sent), len(pending) - len(sent)
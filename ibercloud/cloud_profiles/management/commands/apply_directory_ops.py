@@ -0,0 +1,62 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from cloud_profiles.ldap_pool import BROKEN_CONN_ERRORS
+from cloud_profiles.ldap_users import error_message
+from cloud_profiles.models import DirectoryOperation
+
+
+class Command(NoArgsCommand):
+    help = 'Writes the journaled account operations to the directory'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Operations applied per LDAP connection'),
+        make_option('--loop', action='store_true', dest='loop',
+                    default=False,
+                    help='Keep running, polling the journal'),
+        make_option('--interval', type='int', dest='interval', default=2,
+                    help='Seconds between polls when looping'),
+        make_option('--max-interval', type='int', dest='max_interval',
+                    default=300,
+                    help='Longest wait between polls while the directory '
+                         'is down'),
+        make_option('--retry-failed', action='store_true',
+                    dest='retry_failed', default=False,
+                    help='Move the failed operations back to pending first'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+        if options['retry_failed']:
+            requeued = DirectoryOperation.objects.requeue()
+            if verbosity:
+                self.stdout.write('%d failed operations requeued' % requeued)
+        outages = 0
+        while True:
+            try:
+                done, failed = DirectoryOperation.objects.apply_pending(
+                    options['batch_size'])
+            except BROKEN_CONN_ERRORS as e:
+                if not options['loop']:
+                    raise CommandError('Directory unavailable: %s' %
+                                       error_message(e))
+                # back off while the directory is down, the journal waits
+                outages += 1
+                delay = min(options['interval'] * 2 ** outages,
+                            options['max_interval'])
+                if verbosity:
+                    self.stderr.write('Directory unavailable: %s, retrying '
+                                      'in %ds' % (error_message(e), delay))
+                time.sleep(delay)
+                continue
+            outages = 0
+            if verbosity > 1 or (verbosity and (done or failed)):
+                self.stdout.write('%d applied, %d failed' % (done, failed))
+            if not options['loop']:
+                break
+            # drain the journal before sleeping
+            if done + failed < options['batch_size']:
+                time.sleep(options['interval'])
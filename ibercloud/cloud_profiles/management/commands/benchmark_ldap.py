@@ -0,0 +1,138 @@
+import re
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import NoArgsCommand
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import (override_settings, setup_test_environment,
+                               teardown_test_environment)
+
+from cloud_profiles import fake_ldap, ldap_users
+from cloud_profiles.models import DirectoryOperation, Profile, QueuedMail
+
+BASE_DN = 'ou=bench,o=cloud,dc=ibergrid,dc=eu'
+FAKE_INITIALIZE = 'cloud_profiles.fake_ldap.initialize'
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+class Command(NoArgsCommand):
+    help = ('Measures the ldap_users operations and the registration flow '
+            'against the in process LDAP server of cloud_profiles.fake_ldap '
+            'and a test database')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requests', type='int', dest='requests', default=100,
+                    help='Times each operation is run'),
+        make_option('--latency', type='float', dest='latency', default=1.0,
+                    help='Milliseconds the fake server takes per operation'),
+        make_option('--directory-size', type='int', dest='size',
+                    default=1000,
+                    help='Accounts in the directory for iter_users'),
+        make_option('--page-size', type='int', dest='page_size',
+                    default=500,
+                    help='Page size of the paged searches'),
+    )
+
+    def report(self, name, samples):
+        total = sum(samples)
+        self.stdout.write('%-22s %6d %10.1f %9.2f %9.2f' % (
+            name, len(samples), len(samples) / total if total else 0,
+            percentile(samples, 50) * 1000, percentile(samples, 99) * 1000))
+
+    def timed(self, func, count):
+        samples = []
+        for i in range(count):
+            start = time.time()
+            func(i)
+            samples.append(time.time() - start)
+        return samples
+
+    def handle_noargs(self, **options):
+        n = options['requests']
+        fake_ldap.directory.reset()
+        fake_ldap.directory.latency = 0
+        bench_settings = override_settings(
+            CLOUD_PROFILES_LDAP_INITIALIZE=FAKE_INITIALIZE,
+            CLOUD_PROFILES_LDAP_BASE_DN=BASE_DN,
+            CLOUD_PROFILES_LDAP_PAGE_SIZE=options['page_size'],
+            # the flow registers every user from the same address
+            CLOUD_PROFILES_THROTTLE_LIMITS={},
+            AUTHENTICATION_BACKENDS=(
+                'cloud_profiles.backend.X509Backend',
+                'django.contrib.auth.backends.ModelBackend'),
+        )
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            with bench_settings:
+                self.run_benchmarks(n, options['size'], options['latency'] / 1000.0)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def run_benchmarks(self, n, size, latency):
+        self.stdout.write('%-22s %6s %10s %9s %9s' % (
+            'operation', 'runs', 'ops/s', 'p50 ms', 'p99 ms'))
+        for i in range(size):
+            dn = 'uid=user%d@example.org,%s' % (i, BASE_DN)
+            fake_ldap.directory.add(dn, [('uid', 'user%d@example.org' % i),
+                                         ('cn', 'user %d' % i),
+                                         ('objectClass', 'account')])
+        fake_ldap.directory.latency = latency
+
+        self.report('iter_users', self.timed(
+            lambda i: list(ldap_users.iter_users()), n))
+
+        def create(i):
+            ldap_users.create_user('uid=bench%d,%s' % (i, BASE_DN),
+                                   u'bench%d@example.org' % i,
+                                   u'bench %d' % i, 5000000 + i)
+        self.report('create_user', self.timed(create, n))
+
+        for i in range(n):
+            ldap_users.reset_user_password('uid=bench%d,%s' % (i, BASE_DN),
+                                           'secret%d' % i)
+
+        def check(i):
+            assert ldap_users.check_user_password(
+                'uid=bench%d,%s' % (i, BASE_DN), 'secret%d' % i)
+        self.report('check_user_password', self.timed(check, n))
+
+        self.report('register-activate', self.timed(self.flow(), n))
+
+    def flow(self):
+        staff = User.objects.create_superuser('bench-admin',
+                                              'bench-admin@example.org',
+                                              'bench')
+        admin = Client()
+        admin.login(username=staff.username, password='bench')
+
+        def link(email, name):
+            # path of the `name` url in the last mail sent to `email`
+            prefix = reverse(name, args=['x'])[:-1]
+            mail = QueuedMail.objects.filter(recipients=email).latest('pk')
+            return re.search(re.escape(prefix) + r'\S+', mail.body).group(0)
+
+        def run(i):
+            email = 'flow%d@example.org' % i
+            user = Client()
+            user.post(reverse('registration'), {
+                'name': 'flow %d' % i, 'email': email, 'phone': '0',
+                'institution': 'IFCA', 'country': 'ES',
+                'research_area': 'bench', 'description': 'bench',
+                'resources': 'bench'})
+            user.get(link(email, 'confirm'))
+            profile = Profile.objects.get(email=email)
+            admin.get(reverse('activate', args=[profile.pk]))
+            user.post(link(email, 'reset-password'),
+                      {'new_password1': 'secret', 'new_password2': 'secret'})
+            # what the apply_directory_ops worker does
+            DirectoryOperation.objects.apply_pending()
+            assert Profile.objects.get(pk=profile.pk).check_password('secret')
+        return run
@@ -0,0 +1,72 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.template import loader
+from django.test.utils import override_settings
+
+from cloud_profiles.models import Profile
+from cloud_profiles.warmup import template_names, warm_templates
+
+LOADERS = (
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+)
+CACHED_LOADERS = (
+    ('django.template.loaders.cached.Loader', LOADERS),
+)
+
+
+class Command(NoArgsCommand):
+    help = ('Measures the render time of the cloud_profiles templates '
+            'with the plain and the cached template loaders')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requests', type='int', dest='requests', default=200,
+                    help='Times each template is rendered'),
+    )
+
+    def context(self):
+        profile = Profile(pk=1, name='Bench', email='bench@example.org',
+                          confirmation_key='key', password_key='key')
+        return {'profile': profile, 'token': 'key',
+                'site': {'domain': 'example.org'}}
+
+    def timed(self, name, n):
+        ctx = self.context()
+        start = time.time()
+        for i in range(n):
+            loader.render_to_string(name, ctx)
+        return (time.time() - start) / n
+
+    def handle_noargs(self, **options):
+        n = options['requests']
+        names, skipped = [], []
+        # the pages that need a request or a form can't be rendered here,
+        # they are left out of the timings and listed at the end
+        for name in template_names():
+            try:
+                loader.render_to_string(name, self.context())
+                names.append(name)
+            except Exception as e:
+                skipped.append((name, e))
+        self.stdout.write('%-45s %10s %10s %8s' % ('template', 'plain ms',
+                                                   'cached ms', 'speedup'))
+        total_plain = total_cached = 0
+        for name in names:
+            with override_settings(TEMPLATE_LOADERS=LOADERS):
+                plain = self.timed(name, n)
+            with override_settings(TEMPLATE_LOADERS=CACHED_LOADERS):
+                warm_templates([name])
+                cached = self.timed(name, n)
+            total_plain += plain
+            total_cached += cached
+            self.stdout.write('%-45s %10.3f %10.3f %7.1fx' % (
+                name, plain * 1000, cached * 1000, plain / cached))
+        if names:
+            self.stdout.write('%-45s %10.3f %10.3f %7.1fx' % (
+                'all', total_plain * 1000, total_cached * 1000,
+                total_plain / total_cached))
+        if skipped:
+            self.stderr.write('%d templates not rendered:' % len(skipped))
+            for name, e in skipped:
+                self.stderr.write('  %s: %s: %s' % (name, type(e).__name__, e))
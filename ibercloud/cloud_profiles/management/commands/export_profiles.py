@@ -0,0 +1,44 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from cloud_profiles import export
+
+
+class Command(NoArgsCommand):
+    help = ('Writes the profiles, or with --accounts the directory '
+            'accounts, as CSV or LDIF')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+                    help='csv or ldif'),
+        make_option('--accounts', action='store_true', dest='accounts',
+                    default=False,
+                    help='Export the accounts of the directory'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write, standard output by default'),
+        make_option('--status', dest='status', default=None,
+                    help='Only the profiles with this status'),
+        make_option('--country', dest='country', default=None,
+                    help='Only the profiles of this country'),
+        make_option('--institution', dest='institution', default=None,
+                    help='Only the profiles of this institution'),
+    )
+
+    def handle_noargs(self, **options):
+        fmt = options['format']
+        if fmt not in export.FORMATS:
+            raise CommandError('Unknown format %s' % fmt)
+        if options['accounts']:
+            rows = export.export_accounts(fmt)
+        else:
+            filters = dict((f, options[f]) for f in
+                           ('status', 'country', 'institution') if options[f])
+            rows = export.export_profiles(fmt, filters)
+        if not options['output']:
+            # every record ends with a newline
+            for chunk in rows:
+                self.stdout.write(chunk)
+            return
+        with open(options['output'], 'wb') as out:
+            for chunk in rows:
+                out.write(chunk)
@@ -0,0 +1,52 @@
+import os
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cloud_profiles.models import Profile
+from cloud_profiles.readers import READERS
+
+
+class Command(BaseCommand):
+    args = '<file> [<file> ...]'
+    help = ('Creates the profiles of CSV or LDIF files, e.g. '
+            'cloud_profiles/data/init_profiles.csv')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+                    help='csv or ldif, guessed from the file extension '
+                         'by default'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Profiles inserted per batch'),
+        make_option('--status', dest='status', default=None,
+                    help='Status of the profiles without one in the file'),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError('No file to import')
+        verbosity = int(options.get('verbosity'))
+        for path in paths:
+            fmt = options['format'] or os.path.splitext(path)[1][1:].lower()
+            if fmt not in READERS:
+                raise CommandError('Unknown format %s' % fmt)
+            start = time.time()
+            with open(path, 'rb') as f:
+                rows = READERS[fmt](f)
+                if options['status']:
+                    rows = self.with_status(rows, options['status'])
+                created, skipped = Profile.objects.bulk_new_profiles(
+                    rows, options['batch_size'])
+            elapsed = time.time() - start
+            if verbosity:
+                self.stdout.write('%s: %d created, %d skipped in %.2fs '
+                                  '(%.0f rows/s)' %
+                                  (path, created, skipped, elapsed,
+                                   (created + skipped) / elapsed
+                                   if elapsed else 0))
+
+    def with_status(self, rows, status):
+        for r in rows:
+            r.setdefault('status', status)
+            yield r
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from cloud_profiles.models import Profile
+
+
+class Command(NoArgsCommand):
+    help = ('Clears the confirmation and password keys older than '
+            'CLOUD_PROFILES_TOKEN_TTL')
+
+    def handle_noargs(self, **options):
+        purged = Profile.objects.purge_expired_tokens()
+        if int(options.get('verbosity')):
+            self.stdout.write('%d expired keys cleared' % purged)
@@ -0,0 +1,37 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from cloud_profiles.mail import send_queued_mail
+
+
+class Command(NoArgsCommand):
+    help = 'Sends the queued registration and notification emails'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=50,
+                    help='Messages read from the queue at a time'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=None,
+                    help='Messages sent per SMTP connection, '
+                         'CLOUD_PROFILES_MAIL_CHUNK_SIZE by default'),
+        make_option('--loop', action='store_true', dest='loop',
+                    default=False,
+                    help='Keep running, polling the queue'),
+        make_option('--interval', type='int', dest='interval', default=10,
+                    help='Seconds between polls when looping'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+        while True:
+            sent, failed = send_queued_mail(options['batch_size'],
+                                            options['chunk_size'])
+            if verbosity > 1 or (verbosity and (sent or failed)):
+                self.stdout.write('%d sent, %d failed' % (sent, failed))
+            if not options['loop']:
+                break
+            # drain the queue before sleeping
+            if sent + failed < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,35 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from cloud_profiles.models import DirectoryAccount
+
+
+class Command(NoArgsCommand):
+    help = 'Updates the local mirror of the LDAP accounts'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--full', action='store_true', dest='full',
+                    default=False,
+                    help='Read the whole directory and drop deleted '
+                         'accounts'),
+        make_option('--loop', action='store_true', dest='loop',
+                    default=False,
+                    help='Keep running, syncing the changes periodically'),
+        make_option('--interval', type='int', dest='interval', default=60,
+                    help='Seconds between syncs when looping'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+        full = options['full']
+        while True:
+            created, updated, deleted = DirectoryAccount.objects.sync(full)
+            if verbosity > 1 or (verbosity and (created or updated or
+                                                deleted)):
+                self.stdout.write('%d created, %d updated, %d deleted' %
+                                  (created, updated, deleted))
+            if not options['loop']:
+                break
+            full = False
+            time.sleep(options['interval'])
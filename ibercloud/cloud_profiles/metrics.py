@@ -0,0 +1,287 @@
+#
+# Counters and histograms of the portal, exposed in the Prometheus text
+# format by the /metrics view.
+#
+# Each process keeps its values in memory. With CLOUD_PROFILES_METRICS_DIR
+# set, every process also writes them to <dir>/<pid>.json at most every
+# CLOUD_PROFILES_METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the
+# files of all the processes. Empty the directory when the service starts.
+#
+
+import atexit
+import errno
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_in, user_login_failed
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'ibercloud_logins_total': (
+        'counter', 'Logins by backend and outcome', None),
+    'ibercloud_profile_events_total': (
+        'counter', 'Registrations, confirmations, activations and '
+                   'password resets', None),
+    'ibercloud_throttled_total': (
+        'counter', 'Requests refused by the rate limits by scope and kind',
+        None),
+    'ibercloud_ldap_operation_seconds': (
+        'histogram', 'Time of the LDAP operations by type', LATENCY_BUCKETS),
+    'ibercloud_ldap_pool_connections': (
+        'gauge', 'LDAP pool connections by server and state', None),
+    'ibercloud_ldap_pool_size': (
+        'gauge', 'Max LDAP pool connections by server', None),
+    'ibercloud_ldap_breaker_open': (
+        'gauge', 'Processes with the circuit breaker of the server open',
+        None),
+    'ibercloud_ldap_timeouts_total': (
+        'counter', 'LDAP operations that timed out by server', None),
+    'ibercloud_ldap_deadlines_exceeded_total': (
+        'counter', 'LDAP operations not started as the request budget was '
+                   'spent', None),
+    'ibercloud_x509_cache_entries': (
+        'gauge', 'Entries of the X509 login caches by cache', None),
+    'ibercloud_x509_cache_lookups_total': (
+        'counter', 'Lookups of the X509 login caches by cache and result',
+        None),
+    'ibercloud_mail_queue_depth': (
+        'gauge', 'Queued mails waiting to be sent', None),
+    'ibercloud_directory_ops_pending': (
+        'gauge', 'Journaled directory operations waiting to be applied',
+        None),
+}
+
+_lock = threading.Lock()
+# serializes the writes of the file of the process
+_flush_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_flush = 0
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    buckets = METRICS[name][2]
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                h[0][i] += 1
+                break
+        h[1] += value
+        h[2] += 1
+    _maybe_flush()
+
+
+def _process_gauges():
+    """
+    Values of this process that are read when flushing, the counters of
+    the LDAP layer and of the X509 caches are kept by their modules
+    """
+    # ldap_users and backend import models, which imports this module
+    from cloud_profiles import backend, ldap_users
+    gauges, counters = [], []
+    for pool in ldap_users.pool_stats():
+        labels = {'server': pool['server']}
+        for state in ('in_use', 'idle'):
+            gauges.append(('ibercloud_ldap_pool_connections',
+                           dict(labels, state=state), pool[state]))
+        gauges.append(('ibercloud_ldap_pool_size', labels, pool['size']))
+    for server in ldap_users.server_stats():
+        labels = {'server': server['uri']}
+        gauges.append(('ibercloud_ldap_breaker_open', labels,
+                       int(server['state'] == 'open')))
+        counters.append(('ibercloud_ldap_timeouts_total', labels,
+                         server['timeouts']))
+    counters.append(('ibercloud_ldap_deadlines_exceeded_total', {},
+                     ldap_users.deadline_stats()['exceeded']))
+    for cache, stats in backend.cache_stats().items():
+        labels = {'cache': cache}
+        gauges.append(('ibercloud_x509_cache_entries', labels,
+                       stats['size']))
+        for result, key in (('hit', 'hits'), ('miss', 'misses')):
+            counters.append(('ibercloud_x509_cache_lookups_total',
+                             dict(labels, result=result), stats[key]))
+    return gauges, counters
+
+
+def _snapshot():
+    gauges, counters = _process_gauges()
+    with _lock:
+        return {
+            'counters': [[n, dict(l), v] for (n, l), v in _counters.items()] +
+                        [[n, l, v] for n, l, v in counters],
+            'histograms': [[n, dict(l), h[0], h[1], h[2]]
+                           for (n, l), h in _histograms.items()],
+            'gauges': [[n, l, v] for n, l, v in gauges],
+        }
+
+
+def _metrics_dir():
+    return getattr(settings, 'CLOUD_PROFILES_METRICS_DIR', None)
+
+
+def flush():
+    """
+    Writes the values of this process to its file of the metrics dir
+    """
+    global _last_flush
+    path = _metrics_dir()
+    if not path:
+        return
+    name = os.path.join(path, '%d.json' % os.getpid())
+    with _flush_lock:
+        _last_flush = time.time()
+        with open(name + '.tmp', 'w') as f:
+            json.dump(_snapshot(), f)
+        os.rename(name + '.tmp', name)
+
+
+def _maybe_flush():
+    interval = getattr(settings, 'CLOUD_PROFILES_METRICS_FLUSH_INTERVAL', 1)
+    if _metrics_dir() and time.time() - _last_flush > interval:
+        flush()
+
+
+atexit.register(lambda: _metrics_dir() and flush())
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _read_snapshots():
+    path = _metrics_dir()
+    if not path:
+        return [_snapshot()]
+    flush()
+    snapshots = []
+    for name in os.listdir(path):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(path, name)) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            continue
+        # the gauges of dead processes are stale, their counters are not
+        if not _alive(int(name[:-5])):
+            snapshot['gauges'] = []
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def _global_gauges():
+    from cloud_profiles.models import DirectoryOperation, QueuedMail
+    return [('ibercloud_mail_queue_depth', {}, QueuedMail.objects.count()),
+            ('ibercloud_directory_ops_pending', {},
+             DirectoryOperation.objects.filter(
+                 status=DirectoryOperation.PENDING).count())]
+
+
+def _labels(labels, extra=()):
+    items = sorted(labels.items()) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, unicode(v).replace('\\', r'\\')
+                                                      .replace('"', r'\"')
+                                                      .replace('\n', r'\n'))
+                             for k, v in items)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Returns the metrics of all the processes in the text format
+    """
+    values = {}
+    histograms = {}
+    for snapshot in _read_snapshots():
+        for name, labels, value in snapshot['counters'] + snapshot['gauges']:
+            key = _key(name, labels)
+            values[key] = values.get(key, 0) + value
+        for name, labels, buckets, total, count in snapshot['histograms']:
+            key = _key(name, labels)
+            h = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            h[0] = [a + b for a, b in zip(h[0], buckets)]
+            h[1] += total
+            h[2] += count
+    for name, labels, value in _global_gauges():
+        values[_key(name, labels)] = value
+    lines = []
+    for name in sorted(METRICS):
+        kind, help_text, buckets = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (n, labels), value in sorted(values.items()):
+            if n == name:
+                lines.append('%s%s %s' % (name, _labels(dict(labels)),
+                                          _number(value)))
+        for (n, labels), (counts, total, count) in sorted(histograms.items()):
+            if n != name:
+                continue
+            labels = dict(labels)
+            cumulative = 0
+            for bound, c in zip(buckets, counts):
+                cumulative += c
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(labels, [('le', _number(bound))]),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s' % (name, _labels(labels),
+                                          _number(total)))
+            lines.append('%s_count%s %d' % (name, _labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def _backend_name(path):
+    name = path.rsplit('.', 1)[-1]
+    return {'X509Backend': 'x509',
+            'LDAPBackend': 'ldap',
+            'ModelBackend': 'model'}.get(name, name)
+
+
+def _logged_in(sender, request, user, **kwargs):
+    inc('ibercloud_logins_total', backend=_backend_name(
+        getattr(user, 'backend', 'unknown')), outcome='success')
+
+
+def _login_failed(sender, credentials, **kwargs):
+    # every backend failed, the credentials tell which kind of login it was
+    backend = 'x509' if credentials.get('user_dn') else 'password'
+    inc('ibercloud_logins_total', backend=backend, outcome='failure')
+
+
+user_logged_in.connect(_logged_in)
+user_login_failed.connect(_login_failed)
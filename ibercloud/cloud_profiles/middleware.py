@@ -0,0 +1,99 @@
+import json
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils.functional import SimpleLazyObject
+
+from cloud_profiles import backend, deadlines, timing
+
+logger = logging.getLogger('cloud_profiles.timing')
+
+
+class AuthenticationMiddleware(object):
+    """
+    Replaces django.contrib.auth's: request.user is loaded with its
+    profile in one query, and only if the request uses it
+    """
+
+    def process_request(self, request):
+        request.user = SimpleLazyObject(
+            lambda: backend.get_request_user(request))
+
+
+class RequestDeadlineMiddleware(object):
+    """
+    Limits the time the LDAP calls of a request may take altogether to
+    CLOUD_PROFILES_REQUEST_BUDGET seconds
+    """
+
+    def process_request(self, request):
+        budget = getattr(settings, 'CLOUD_PROFILES_REQUEST_BUDGET', 20)
+        if budget:
+            deadlines.start(budget)
+
+    def process_response(self, request, response):
+        deadlines.clear()
+        return response
+
+
+class TimingMiddleware(object):
+    """
+    Times the database queries, LDAP calls, mail and template rendering
+    of a CLOUD_PROFILES_TIMING_SAMPLE_RATE fraction of the requests, and
+    reports them in a Server-Timing header and a log line. Subsystems
+    may overlap, e.g. queueing a mail is also a database query.
+    """
+
+    def process_request(self, request):
+        rate = getattr(settings, 'CLOUD_PROFILES_TIMING_SAMPLE_RATE', 0)
+        if not rate or random.random() >= rate:
+            return
+        request._timings = timing.start()
+        # the debug cursor stores the queries and their time
+        request._timing_queries = {}
+        for conn in connections.all():
+            request._timing_queries[conn.alias] = (conn.use_debug_cursor,
+                                                   len(conn.queries))
+            conn.use_debug_cursor = True
+
+    def process_template_response(self, request, response):
+        timings = getattr(request, '_timings', None)
+        if timings is not None:
+            # rendering starts after the template response middlewares
+            start = time.time()
+            response.add_post_render_callback(
+                lambda r: timings.add('template', time.time() - start))
+        return response
+
+    def process_response(self, request, response):
+        timings = getattr(request, '_timings', None)
+        if timings is None:
+            return response
+        timing.stop()
+        for conn in connections.all():
+            if conn.alias not in request._timing_queries:
+                continue
+            use_debug_cursor, first = request._timing_queries[conn.alias]
+            queries = conn.queries[first:]
+            timings.add('db', sum(float(q['time']) for q in queries),
+                        len(queries))
+            conn.use_debug_cursor = use_debug_cursor
+        total = timings.total()
+        subsystems = sorted(timings.subsystems.items())
+        response['Server-Timing'] = ', '.join(
+            ['%s;dur=%.1f;desc="%d calls"' % (name, elapsed * 1000, calls)
+             for name, (calls, elapsed) in subsystems] +
+            ['total;dur=%.1f' % (total * 1000)])
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round(total * 1000, 1),
+            'subsystems': dict((name, {'calls': calls,
+                                       'ms': round(elapsed * 1000, 1)})
+                               for name, (calls, elapsed) in subsystems),
+        }, sort_keys=True))
+        return response
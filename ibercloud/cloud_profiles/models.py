@@ -1,12 +1,22 @@
 
-import hashlib
-import random
+import json
+from datetime import timedelta
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
+from django.dispatch import Signal
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 import ldap_users
+import metrics
+import tokens
+import uids
+from utils import chunked, commit_on_success
+
+# sent after a bulk activation, which does not send post_save
+profiles_activated = Signal(providing_args=['profiles'])
 
 COUNTRIES = (
     ('ES', 'Spain'),
@@ -16,33 +26,176 @@ COUNTRIES = (
 
 class ProfileManager(models.Manager):
     def create(self, *args, **kwargs):
-        p = super(ProfileManager, self).create(*args, **kwargs)
+        # the keys are set before the insert, no second save
+        p = self.model(*args, **kwargs)
         p.create_user_keys()
-        p.save()
+        p.save(force_insert=True, using=self.db)
         return p
 
+    def new_tokens(self, n):
+        """
+        Returns `n` (token, hash) pairs of tokens.new_tokens, drawing
+        again the ones whose hash is already the key of a profile
+        """
+        pairs = {}
+        while len(pairs) < n:
+            drawn = dict((h, t) for t, h in tokens.new_tokens(n - len(pairs))
+                         if h not in pairs)
+            for keys in self.filter(
+                    Q(confirmation_key__in=drawn.keys()) |
+                    Q(password_key__in=drawn.keys())).values_list(
+                    'confirmation_key', 'password_key'):
+                for key in keys:
+                    drawn.pop(key, None)
+            pairs.update(drawn)
+        return [(t, h) for h, t in pairs.items()]
+
     def new_profile(self, *args, **kwargs):
-        p = self.create(*args, **kwargs)
+        """
+        Creates a profile and its inactive user, or links it to the
+        existing user of the email, in one transaction
+        """
         model = get_user_model()
-        defaults = {'is_active': False}
-        p.user, created = model.objects.get_or_create(username=p.email,
-                                                      defaults=defaults)
-        if created:
-            p.user.set_unusable_password()
-            p.user.save()
-        p.save()
+        email = kwargs['email']
+        with commit_on_success():
+            try:
+                user = model.objects.get(username=email)
+            except model.DoesNotExist:
+                user = model(username=email, is_active=False)
+                user.set_unusable_password()
+                user.save(force_insert=True)
+            p = self.create(user=user, *args, **kwargs)
+        metrics.inc('ibercloud_profile_events_total', event='registration')
         return p
 
+    def bulk_new_profiles(self, rows, batch_size=500):
+        """
+        Creates the profiles of the field dicts in `rows`, and their
+        inactive users, with a few queries per batch of `batch_size`.
+        Emails that already have a profile are skipped. Returns the
+        number of profiles created and skipped.
+        """
+        created = skipped = 0
+        for batch in chunked(rows, batch_size):
+            existing = set(self.filter(
+                email__in=[r['email'] for r in batch]).values_list(
+                'email', flat=True))
+            new = {}
+            for r in batch:
+                if r['email'] not in existing:
+                    new.setdefault(r['email'], r)
+            skipped += len(batch) - len(new)
+            if not new:
+                continue
+            model = get_user_model()
+            with commit_on_success():
+                users = dict(model.objects.filter(
+                    username__in=new.keys()).values_list('username', 'pk'))
+                missing = []
+                for email in new:
+                    if email not in users:
+                        u = model(username=email, is_active=False)
+                        u.set_unusable_password()
+                        missing.append(u)
+                model.objects.bulk_create(missing)
+                users.update(model.objects.filter(
+                    username__in=[u.username for u in missing]).values_list(
+                    'username', 'pk'))
+                profiles = []
+                keys = self.new_tokens(2 * len(new))
+                for i, (email, r) in enumerate(new.items()):
+                    p = self.model(user_id=users[email], **r)
+                    p.create_user_keys(keys[2 * i:2 * i + 2])
+                    profiles.append(p)
+                self.bulk_create(profiles)
+            created += len(profiles)
+        return created, skipped
+
+    def activate_profiles(self, profiles):
+        """
+        Activates the given profiles in bulk: the LDAP account creations
+        are journaled and the database rows updated in one transaction.
+        Each profile gets a new password key for its activation email.
+        Returns a dict of profile pk -> error message, None for the
+        profiles that were activated.
+        """
+        results = {}
+        pending = []
+        for p in profiles:
+            if p.can_be_activated():
+                pending.append(p)
+            else:
+                results[p.pk] = 'profile is not pending activation'
+        if pending:
+            self.allocate_uids(pending)
+            with commit_on_success():
+                DirectoryOperation.objects.bulk_create([
+                    DirectoryOperation(op=ldap_users.CREATE, dn=p.get_dn(),
+                                       data=json.dumps(p.get_account_data()))
+                    for p in pending])
+                self.filter(pk__in=[p.pk for p in pending]).update(
+                    status=self.model.VALID)
+                for p, key in zip(pending, self.new_tokens(len(pending))):
+                    p.new_password_key(key)
+                    self.filter(pk=p.pk).update(
+                        uid_number=p.uid_number,
+                        password_key=p.password_key,
+                        password_issued=p.password_issued)
+                get_user_model().objects.filter(
+                    pk__in=[p.user_id for p in pending]).update(
+                    is_active=True)
+            for p in pending:
+                p.status = self.model.VALID
+                results[p.pk] = None
+            profiles_activated.send(sender=self.model, profiles=pending)
+            metrics.inc('ibercloud_profile_events_total', len(pending),
+                        event='activation')
+        return results
+
+    def allocate_uids(self, profiles):
+        """
+        Sets the uid_number of the profiles without one, reserving the
+        uids of each country at once
+        """
+        by_country = {}
+        for p in profiles:
+            if p.uid_number is None:
+                by_country.setdefault(p.country, []).append(p)
+        for country, ps in by_country.items():
+            for p, uid in zip(ps, uids.allocate(country, len(ps))):
+                p.uid_number = uid
+
+    def with_token(self, kind, token):
+        """
+        Profiles with the unexpired 'confirmation' or 'password' `token`
+        """
+        return self.filter(**{
+            '%s_key' % kind: tokens.hash_token(token),
+            '%s_issued__gt' % kind: tokens.issued_after(kind),
+        })
+
+    def purge_expired_tokens(self):
+        """
+        Clears the keys of the expired tokens, returns how many were
+        cleared
+        """
+        purged = 0
+        for kind in ('confirmation', 'password'):
+            purged += self.filter(**{
+                '%s_issued__lt' % kind: tokens.issued_after(kind),
+            }).update(**{'%s_key' % kind: '', '%s_issued' % kind: None})
+        return purged
+
     def profile_from_user(self, user):
         try: 
             p = self.get(email=user.email)
             p.user = user
+            p.save()
         except Profile.DoesNotExist:
             p = self.create(email=user.email,
                             name=user.username,
-                            user=user)
-            p.status = p.EXTERNAL
-        p.save()
+                            user=user,
+                            status=Profile.EXTERNAL)
         return p
 
 
@@ -65,11 +218,11 @@ class Profile(models.Model):
     name = models.CharField(max_length=50, blank=True)
     email = models.EmailField(unique=True)
     phone = models.CharField(max_length=30, blank=True)
-    institution = models.CharField(max_length=50, blank=True)
+    institution = models.CharField(max_length=50, blank=True, db_index=True)
     country = models.CharField(max_length=3, choices=COUNTRIES,
-                               default='ES', blank=True)
+                               default='ES', blank=True, db_index=True)
     # cert of user
-    user_dn = models.CharField(max_length=100, blank=True)
+    user_dn = models.CharField(max_length=100, blank=True, db_index=True)
     # Additional info for no cert users
     research_area = models.CharField(max_length=50, blank=True)
     description = models.TextField(help_text="Describe briefly the scientific "
@@ -79,19 +232,30 @@ class Profile(models.Model):
     resources = models.TextField(help_text="Describe briefly the "
                                            "resources needed",
                                  blank=True)
-    # the validation request code, (generated when the user is created)
-    confirmation_key = models.CharField(max_length=100)
+    # sha256 of the tokens sent to the user to confirm the registration
+    # and to set the password, see cloud_profiles.tokens
+    confirmation_key = models.CharField(max_length=100, db_index=True)
     password_key = models.CharField(max_length=100)
+    # when the tokens were issued, they expire after their ttl
+    confirmation_issued = models.DateTimeField(null=True, blank=True)
+    password_issued = models.DateTimeField(null=True, blank=True)
     # status of the profile
-    status = models.CharField(max_length=2, choices=STATUS, default=CREATED)
+    status = models.CharField(max_length=2, choices=STATUS, default=CREATED,
+                              db_index=True)
     # the django user
     user = models.OneToOneField(settings.AUTH_USER_MODEL,
                                 null=True, blank=True)
+    # uidNumber of the LDAP account, allocated on activation
+    uid_number = models.IntegerField(null=True, blank=True, unique=True)
 
     class Meta:
         permissions = (
             ('list_users', 'Can list ldap users'),
         )
+        # password reset looks up by key and status
+        index_together = (
+            ('password_key', 'status'),
+        )
 
 
     def __unicode__(self):
@@ -103,20 +267,31 @@ class Profile(models.Model):
         else:
             return 'uid=%s,ou=users,c=pt,o=cloud,dc=ibergrid,dc=eu' % str(self.email)
 
-    def create_user_keys(self):
-        salt1 = hashlib.sha1(str(random.random())).hexdigest()[:6]
-        salt2 = hashlib.sha1(str(random.random())).hexdigest()[:6]
-        self.confirmation_key = hashlib.sha1(salt1+self.email).hexdigest()
-        self.password_key = hashlib.sha1(salt2+self.email).hexdigest()
+    def create_user_keys(self, keys=None):
+        """
+        Sets new keys from two (token, hash) pairs of new_tokens.
+        The confirmation token is kept in confirmation_token for the
+        registration email, the password key is not usable until
+        new_password_key is called on activation.
+        """
+        confirmation, password = keys or Profile.objects.new_tokens(2)
+        self.confirmation_token, self.confirmation_key = confirmation
+        self.confirmation_issued = timezone.now()
+        self.password_key = password[1]
+        self.password_issued = None
+
+    def new_password_key(self, key=None):
+        """
+        Sets a new password key, the token is kept in password_token
+        """
+        self.password_token, self.password_key = (
+            key or Profile.objects.new_tokens(1)[0])
+        self.password_issued = timezone.now()
 
     def get_uid(self):
-        if self.country == 'ES':
-            base = 1000000
-        elif self.country == 'PT':
-            base = 2000000
-        else:
-            base = 9000000
-        return base + self.pk
+        if self.uid_number is None:
+            self.uid_number = uids.allocate(self.country)[0]
+        return self.uid_number
 
     def check_password(self, passwd):
         return ldap_users.check_user_password(self.get_dn(), passwd)
@@ -124,32 +299,327 @@ class Profile(models.Model):
     def update_password(self, old, new):
         ldap_users.change_user_password(self.get_dn(), old, new)
 
+    def get_account_data(self):
+        return {'email': self.email, 'name': self.name,
+                'uid': self.get_uid()}
+
+    def reissue_password_key(self):
+        """
+        Sets a new password key for a valid profile whose activation link
+        expired or got lost, returns False if the profile is not valid
+        """
+        if self.status != self.VALID:
+            return False
+        self.new_password_key()
+        self.save(update_fields=['password_key', 'password_issued'])
+        return True
+
     def password_reset(self, password):
         if self.status != self.VALID:
             return
-        ldap_users.reset_user_password(self.get_dn(), password)
-        self.status = self.ACTIVE
-        self.save()
+        with commit_on_success():
+            DirectoryOperation.objects.enqueue(
+                ldap_users.RESET_PASSWORD, self.get_dn(),
+                password=ldap_users.hash_password(password))
+            self.status = self.ACTIVE
+            # the token is used once
+            self.password_key = ''
+            self.password_issued = None
+            self.save()
+        metrics.inc('ibercloud_profile_events_total', event='password_reset')
 
     def activate(self):
-        ldap_users.create_user(self.get_dn(), self.email,
-                               self.name, self.get_uid())
-        self.status = self.VALID
-        self.user.is_active = True
-        self.user.save()
-        self.save()
+        if not self.can_be_activated():
+            return False
+        # the uid block is reserved in its own transaction
+        self.get_uid()
+        with commit_on_success():
+            DirectoryOperation.objects.enqueue(ldap_users.CREATE,
+                                               self.get_dn(),
+                                               **self.get_account_data())
+            self.status = self.VALID
+            self.new_password_key()
+            self.user.is_active = True
+            self.user.save()
+            self.save()
+        metrics.inc('ibercloud_profile_events_total', event='activation')
+        return True
 
     def confirm(self):
         if self.status != self.CREATED:
             return False
         self.status = self.CONFIRMED
         self.save()
+        metrics.inc('ibercloud_profile_events_total', event='confirmation')
         return True
 
     def delete(self, *args, **kwargs):
-        if self.status in [self.VALID, self.ACTIVE]:
-            ldap_users.delete_user(self.get_dn())
-        super(Profile, self).delete(*args, **kwargs)
+        with commit_on_success():
+            if self.status in [self.VALID, self.ACTIVE]:
+                DirectoryOperation.objects.enqueue(ldap_users.DELETE,
+                                                   self.get_dn())
+            super(Profile, self).delete(*args, **kwargs)
 
     def can_be_activated(self):
         return self.status in [self.CREATED, self.CONFIRMED]
+
+
+class QueuedMail(models.Model):
+    """
+    An email waiting to be sent by the send_queued_mail command
+    """
+    subject = models.CharField(max_length=200)
+    body = models.TextField()
+    from_email = models.CharField(max_length=200)
+    # comma separated list of addresses
+    recipients = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    # delivery attempts done so far and when to try again
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    # token of the send_queued_mail run sending it
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.recipients, self.subject)
+
+    def get_recipients(self):
+        return [r for r in self.recipients.split(',') if r]
+
+
+class DirectoryAccountManager(models.Manager):
+    def record_changes(self, removed_dns, new_users=()):
+        if removed_dns:
+            self.filter(dn__in=removed_dns).delete()
+        self.bulk_create([self.model.from_user(u) for u in new_users])
+
+    def sync(self, full=False, chunk_size=500):
+        """
+        Updates the mirror with the accounts modified in the directory
+        since the latest modifyTimestamp already mirrored. Deleted
+        accounts are only noticed by a full sync, which also runs if no
+        account of the mirror has been read from the directory yet (the
+        ones written by the portal have no timestamp). Returns (created,
+        updated, deleted) counts.
+        """
+        since = None
+        if not full:
+            since = self.exclude(modify_timestamp='').aggregate(
+                m=models.Max('modify_timestamp'))['m']
+        seen = set()
+        created = updated = deleted = 0
+        for chunk in chunked(ldap_users.iter_users(since=since), chunk_size):
+            existing = self.in_bulk_by_dn([u['dn'] for u in chunk])
+            new = []
+            for u in chunk:
+                seen.add(u['dn'])
+                account = existing.get(u['dn'])
+                if account is None:
+                    new.append(self.model.from_user(u))
+                elif account.update_from_user(u):
+                    account.save()
+                    updated += 1
+            self.bulk_create(new)
+            created += len(new)
+        if since is None:
+            stale = [pk for pk, dn in self.values_list('pk', 'dn').iterator()
+                     if dn not in seen]
+            for pks in chunked(stale, chunk_size):
+                self.filter(pk__in=pks).delete()
+            deleted = len(stale)
+        return created, updated, deleted
+
+    def in_bulk_by_dn(self, dns):
+        return dict((a.dn, a) for a in self.filter(dn__in=dns))
+
+
+class DirectoryAccount(models.Model):
+    """
+    Local copy of an LDAP account, kept up to date by the sync_directory
+    command and by the writes done through ldap_users
+    """
+    objects = DirectoryAccountManager()
+
+    dn = models.CharField(max_length=255, unique=True)
+    # uid attribute of the account
+    email = models.CharField(max_length=255, db_index=True)
+    name = models.CharField(max_length=255, blank=True)
+    uid_number = models.IntegerField(null=True, blank=True, db_index=True)
+    # generalized time of the last change seen, empty for the accounts
+    # written by the portal until the next sync reads them
+    modify_timestamp = models.CharField(max_length=32, blank=True,
+                                        db_index=True)
+
+    def __unicode__(self):
+        return self.dn
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(dn=user['dn'], email=user['email'], name=user['name'],
+                   uid_number=user['uid_number'],
+                   modify_timestamp=user['modify_timestamp'])
+
+    def update_from_user(self, user):
+        changed = False
+        for field in ('email', 'name', 'uid_number', 'modify_timestamp'):
+            if getattr(self, field) != user[field]:
+                setattr(self, field, user[field])
+                changed = True
+        return changed
+
+
+class DirectoryOperationManager(models.Manager):
+    def enqueue(self, op, dn, **data):
+        return self.create(op=op, dn=dn, data=json.dumps(data))
+
+    def due(self):
+        """
+        Pending operations that can run now, in journal order. The ones
+        on the entry of an operation waiting for its retry wait with it.
+        """
+        pending = self.filter(status=self.model.PENDING)
+        waiting = pending.filter(next_attempt__gt=timezone.now())
+        return pending.exclude(dn__in=waiting.values('dn')).order_by('pk')
+
+    def apply_pending(self, batch_size=100):
+        """
+        Applies the oldest due operations over one LDAP connection.
+        Failed ones are retried after CLOUD_PROFILES_LDAP_OPS_RETRY_DELAY,
+        doubled on each attempt, until CLOUD_PROFILES_LDAP_OPS_MAX_ATTEMPTS.
+        If the directory can not be reached, the operations not applied
+        keep their attempts and the connection error is raised. Returns
+        (done, failed).
+        """
+        max_attempts = getattr(settings,
+                               'CLOUD_PROFILES_LDAP_OPS_MAX_ATTEMPTS', 5)
+        delay = getattr(settings, 'CLOUD_PROFILES_LDAP_OPS_RETRY_DELAY', 30)
+        ops = list(self.due()[:batch_size])
+        if not ops:
+            return 0, 0
+        results = ldap_users.apply_operations(
+            [(o.op, o.dn, json.loads(o.data)) for o in ops])
+        done = []
+        failed = 0
+        outage = None
+        for o, error in zip(ops, results):
+            if error is None:
+                done.append(o.pk)
+                continue
+            if isinstance(error, ldap_users.BROKEN_CONN_ERRORS):
+                # not the fault of the operation
+                outage = error
+                continue
+            failed += 1
+            o.attempts += 1
+            o.last_error = ldap_users.error_message(error)
+            o.next_attempt = timezone.now() + timedelta(
+                seconds=delay * 2 ** (o.attempts - 1))
+            if o.attempts >= max_attempts:
+                o.status = self.model.FAILED
+            o.save()
+        self.filter(pk__in=done).update(status=self.model.DONE,
+                                        updated=timezone.now())
+        if outage is not None:
+            raise outage
+        return len(done), failed
+
+    def requeue(self, queryset=None):
+        """
+        Moves the failed operations of `queryset`, all by default, back
+        to pending with their attempts reset. Returns how many.
+        """
+        if queryset is None:
+            queryset = self.all()
+        return queryset.filter(status=self.model.FAILED).update(
+            status=self.model.PENDING, attempts=0,
+            next_attempt=timezone.now(), updated=timezone.now())
+
+
+class DirectoryOperation(models.Model):
+    """
+    Journal of the writes to the directory, applied in order by the
+    apply_directory_ops command so that requests do not wait for LDAP
+    """
+    objects = DirectoryOperationManager()
+
+    PENDING = 'PE'
+    DONE = 'DO'
+    FAILED = 'FA'
+    STATUS = (
+        (PENDING, 'Pending'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+    OPS = (
+        (ldap_users.CREATE, 'Create account'),
+        (ldap_users.DELETE, 'Delete account'),
+        (ldap_users.RESET_PASSWORD, 'Reset password'),
+    )
+    op = models.CharField(max_length=20, choices=OPS)
+    dn = models.CharField(max_length=255)
+    # json encoded arguments of the operation
+    data = models.TextField(blank=True)
+    status = models.CharField(max_length=2, choices=STATUS, default=PENDING,
+                              db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return '%s %s' % (self.op, self.dn)
+
+
+class UidSequenceManager(models.Manager):
+    def first_free(self, base):
+        """
+        First uid of the range of `base` after the ones of the directory
+        mirror and the base + profile pk uids given before the sequences
+        """
+        used = DirectoryAccount.objects.filter(
+            uid_number__gte=base,
+            uid_number__lt=base + uids.RANGE_SIZE).aggregate(
+            m=models.Max('uid_number'))['m']
+        last_pk = Profile.objects.aggregate(m=models.Max('pk'))['m']
+        return max(used or base, base + (last_pk or 0)) + 1
+
+    def reserve(self, base, n):
+        """
+        Reserves the next `n` free uids of the range of `base` with one
+        locked update of its sequence, skipping the uids the directory
+        mirror shows as taken. It commits, even the transaction of the
+        caller, as the process keeps the uids whatever the caller does.
+        """
+        reserved = []
+        with transaction.commit_on_success():
+            try:
+                seq = self.select_for_update().get(base=base)
+            except self.model.DoesNotExist:
+                seq, created = self.select_for_update().get_or_create(
+                    base=base, defaults={'next_uid': self.first_free(base)})
+            while len(reserved) < n:
+                start = seq.next_uid
+                seq.next_uid += n - len(reserved)
+                taken = set(DirectoryAccount.objects.filter(
+                    uid_number__gte=start,
+                    uid_number__lt=seq.next_uid).values_list(
+                    'uid_number', flat=True))
+                reserved.extend(u for u in range(start, seq.next_uid)
+                                if u not in taken)
+            seq.save()
+        return reserved
+
+
+class UidSequence(models.Model):
+    """
+    Next uid to reserve of a uid range, see cloud_profiles.uids
+    """
+    objects = UidSequenceManager()
+
+    base = models.IntegerField(unique=True)
+    next_uid = models.IntegerField()
+
+    def __unicode__(self):
+        return '%d: %d' % (self.base, self.next_uid)
@@ -0,0 +1,75 @@
+#
+# Streaming readers of profiles in CSV and LDIF, the formats written by
+# cloud_profiles.export
+#
+
+import csv
+from cStringIO import StringIO
+
+import ldif
+
+# profile fields that can be imported
+FIELDS = ('email', 'name', 'phone', 'institution', 'country', 'status',
+          'user_dn', 'research_area', 'description', 'resources')
+
+# LDIF attribute -> profile field
+LDIF_ATTRS = {
+    'uid': 'email',
+    'cn': 'name',
+    'telephonenumber': 'phone',
+    'o': 'institution',
+    'c': 'country',
+}
+
+
+def read_csv(f):
+    """
+    Yields a dict of FIELDS for each line of the CSV file `f`, which has
+    a header with the field names
+    """
+    for line in csv.DictReader(f):
+        yield dict((k, v.decode('utf-8')) for k, v in line.items()
+                   if k in FIELDS and v)
+
+
+class _EntryParser(ldif.LDIFParser):
+    def handle(self, dn, entry):
+        self.entries.append((dn, entry))
+
+
+def _ldif_records(f):
+    # records are separated by empty lines
+    record = []
+    for line in f:
+        if line.strip():
+            record.append(line)
+        elif record:
+            yield ''.join(record)
+            record = []
+    if record:
+        yield ''.join(record)
+
+
+def read_ldif(f):
+    """
+    Yields a dict of FIELDS for each entry of the LDIF file `f`, parsing
+    one record at a time
+    """
+    for record in _ldif_records(f):
+        parser = _EntryParser(StringIO(record))
+        parser.entries = []
+        parser.parse()
+        for dn, entry in parser.entries:
+            row = {}
+            for attr, values in entry.items():
+                field = LDIF_ATTRS.get(attr.lower())
+                if field and values:
+                    row[field] = values[0].decode('utf-8')
+            if row:
+                yield row
+
+
+READERS = {
+    'csv': read_csv,
+    'ldif': read_ldif,
+}
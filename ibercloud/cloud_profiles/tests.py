@@ -1,16 +1,1149 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+import csv
+import json
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+from datetime import timedelta
+from cStringIO import StringIO
 
-Replace this with more appropriate tests for your application.
-"""
+import ldap
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.template import loader
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.unittest import skipUnless
 
-from django.test import TestCase
+from cloud_profiles import (backend, deadlines, export, fake_ldap, ldap_users,
+                            metrics, readers, throttle, tokens, uids,
+                            warmup)
+from cloud_profiles.ldap_pool import ConnectionPool, PoolExhausted
+from cloud_profiles.ldap_servers import CircuitBreaker, CircuitOpen
+from cloud_profiles.middleware import RequestDeadlineMiddleware
+from cloud_profiles.mail import (claim_queued_mail, queue_mail,
+                                 send_queued_mail)
+from cloud_profiles.models import (DirectoryAccount, DirectoryOperation,
+                                   Profile, QueuedMail, UidSequence)
+from cloud_profiles import views
+from cloud_profiles.views import ProfileList, UserList
 
+INIT_PROFILES = os.path.join(os.path.dirname(__file__), 'data',
+                             'init_profiles.csv')
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+
+class DummyConn(object):
+    def __init__(self):
+        self.unbound = False
+
+    def whoami_s(self):
+        return 'dn:cn=admin'
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+class ConnectionPoolTest(TestCase):
+    def get_pool(self, **kwargs):
+        return ConnectionPool('ldap://test', 'cn=admin', 'secret',
+                              lambda *args: DummyConn(), **kwargs)
+
+    def test_reuse(self):
+        pool = self.get_pool()
+        with pool.connection() as c1:
+            pass
+        with pool.connection() as c2:
+            pass
+        self.assertTrue(c1 is c2)
+        stats = pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_discard_broken(self):
+        pool = self.get_pool()
+        try:
+            with pool.connection() as c1:
+                raise ldap.SERVER_DOWN()
+        except ldap.SERVER_DOWN:
+            pass
+        self.assertTrue(c1.unbound)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_idle_timeout(self):
+        pool = self.get_pool(idle_timeout=-1)
+        with pool.connection() as c1:
+            pass
+        with pool.connection() as c2:
+            pass
+        self.assertFalse(c1 is c2)
+        self.assertEqual(pool.stats()['expired'], 1)
+
+    def test_bounded(self):
+        pool = self.get_pool(size=1, wait_timeout=0)
+        with pool.connection():
+            self.assertRaises(PoolExhausted, pool.acquire)
+
+
+class UserListTest(TestCase):
+    def test_list(self):
+        Profile.objects.create(email='a@example.org', status=Profile.ACTIVE)
+        for email in ('a@example.org', 'b@example.org'):
+            DirectoryAccount.objects.create(dn='uid=%s' % email, email=email)
+        view = UserList()
+        with self.assertNumQueries(2):
+            users = list(view.iter_users())
+        self.assertEqual([u['status'] for u in users], [Profile.ACTIVE, 'EX'])
+
+    def test_statuses_bulk_lookup(self):
+        for i in range(5):
+            Profile.objects.create(email='user%d@example.org' % i,
+                                   status=Profile.CONFIRMED)
+        emails = ['user%d@example.org' % i for i in range(10)]
+        view = UserList()
+        view.chunk_size = 4
+        with self.assertNumQueries(3):
+            statuses = view.get_statuses(emails)
+        self.assertEqual(len(statuses), 5)
+        self.assertEqual(statuses['user0@example.org'], Profile.CONFIRMED)
+
+
+@skipUnless(connection.vendor in ('sqlite', 'mysql', 'postgresql'),
+            'no query plan check for %s' % connection.vendor)
+class ProfileIndexTest(TestCase):
+    def plan(self, qs):
+        sql, params = qs.query.sql_with_params()
+        cursor = connection.cursor()
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(str(row[-1]) for row in cursor.fetchall())
+        if connection.vendor == 'postgresql':
+            # the tables of the tests are too small for an index scan
+            cursor.execute('SET enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            return ' '.join(row[0] for row in cursor.fetchall())
+        cursor.execute('EXPLAIN ' + sql, params)
+        key = [c[0] for c in cursor.description].index('key')
+        return ' '.join(str(row[key]) for row in cursor.fetchall())
+
+    def assertUsesIndex(self, qs, *fields):
+        # the name given by syncdb and sqlindexes
+        name = '%s_%s' % (Profile._meta.db_table,
+                          connection.creation._digest(list(fields)))
+        plan = self.plan(qs)
+        self.assertTrue(name in plan, plan)
+
+    def test_user_dn(self):
+        self.assertUsesIndex(Profile.objects.filter(user_dn='/CN=test'),
+                             'user_dn')
+
+    def test_confirmation_key(self):
+        self.assertUsesIndex(Profile.objects.filter(confirmation_key='key'),
+                             'confirmation_key')
+
+    def test_password_key_status(self):
+        self.assertUsesIndex(Profile.objects.filter(password_key='key',
+                                                    status=Profile.VALID),
+                             'password_key', 'status')
+
+    def test_status(self):
+        self.assertUsesIndex(Profile.objects.filter(status=Profile.CONFIRMED),
+                             'status')
+
+
+class RefusingEmailBackend(locmem.EmailBackend):
+    opened = 0
+
+    def open(self):
+        RefusingEmailBackend.opened += 1
+
+    def send_messages(self, messages):
+        if messages[0].to == ['bad@example.org']:
+            raise smtplib.SMTPRecipientsRefused(
+                {'bad@example.org': (550, 'No such user')})
+        return super(RefusingEmailBackend, self).send_messages(messages)
+
+
+class MailQueueTest(TestCase):
+    def test_queue_and_send(self):
+        queue_mail('subject', 'body', 'from@example.org',
+                   ['a@example.org', 'b@example.org'])
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(send_queued_mail(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['a@example.org',
+                                             'b@example.org'])
+        self.assertEqual(QueuedMail.objects.count(), 0)
+
+    @override_settings(
+        EMAIL_BACKEND='cloud_profiles.tests.RefusingEmailBackend')
+    def test_chunks_and_failures(self):
+        RefusingEmailBackend.opened = 0
+        for to in ('a', 'bad', 'b', 'c', 'd'):
+            queue_mail('subject', 'body', 'from@example.org',
+                       ['%s@example.org' % to])
+        self.assertEqual(send_queued_mail(chunk_size=2), (4, 1))
+        # one connection per chunk
+        self.assertEqual(RefusingEmailBackend.opened, 3)
+        self.assertEqual(len(mail.outbox), 4)
+        failed = QueuedMail.objects.get()
+        self.assertEqual(failed.attempts, 1)
+        self.assertTrue(failed.last_error.startswith('bad@example.org: '))
+
+
+class MailClaimTest(TestCase):
+    def test_concurrent_runs(self):
+        for to in ('a', 'b', 'c'):
+            queue_mail('subject', 'body', 'from@example.org',
+                       ['%s@example.org' % to])
+        first = claim_queued_mail(2)
+        self.assertEqual(len(first), 2)
+        # another run only gets the mail left
+        second = claim_queued_mail(10)
+        self.assertEqual([m.recipients for m in second], ['c@example.org'])
+        self.assertEqual(claim_queued_mail(10), [])
+        self.assertEqual(send_queued_mail(), (0, 0))
+        # the claims of a run that died expire
+        QueuedMail.objects.update(next_attempt=timezone.now())
+        self.assertEqual(send_queued_mail(), (3, 0))
+
+
+class X509BackendTest(TestCase):
+    dn = '/DC=es/DC=irisgrid/O=ifca/CN=test'
+
+    def setUp(self):
+        backend.dn_cache.clear()
+        backend.user_cache.clear()
+        self.user = User.objects.create(username='test@example.org')
+        Profile.objects.create(email='test@example.org', user_dn=self.dn,
+                               user=self.user)
+        self.backend = backend.X509Backend()
+
+    def test_cached(self):
+        self.assertEqual(self.backend.authenticate(user_dn=self.dn),
+                         self.user)
+        with self.assertNumQueries(0):
+            user = self.backend.authenticate(user_dn=self.dn)
+            self.assertEqual(user.profile.user_dn, self.dn)
+        self.assertEqual(backend.dn_cache.stats()['hits'], 1)
+
+    def test_invalidate_inactive(self):
+        self.backend.authenticate(user_dn=self.dn)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.backend.authenticate(user_dn=self.dn), None)
+
+    def test_invalidate_dn_change(self):
+        self.backend.authenticate(user_dn=self.dn)
+        profile = Profile.objects.get(user_dn=self.dn)
+        profile.user_dn = '/CN=other'
+        profile.save()
+        self.assertEqual(self.backend.authenticate(user_dn=self.dn), None)
+
+    def test_keep_other_dns(self):
+        self.backend.authenticate(user_dn=self.dn)
+        # registrations and confirmations do not drop the cached DNs
+        p = Profile.objects.new_profile(email='other@example.org',
+                                        user_dn='/CN=other')
+        p.confirm()
+        with self.assertNumQueries(0):
+            self.backend.authenticate(user_dn=self.dn)
+        text = metrics.render()
+        self.assertTrue('ibercloud_x509_cache_lookups_total'
+                        '{cache="dn",result="hit"} %d' %
+                        backend.dn_cache.stats()['hits'] in text, text)
+        self.assertTrue('ibercloud_x509_cache_entries{cache="dn"} 1' in text)
+
+
+@override_settings(
+    SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+    MIDDLEWARE_CLASSES=(
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'cloud_profiles.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware'))
+class SessionUserTest(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='test@example.org')
+        user.set_password('secret')
+        user.save()
+        Profile.objects.create(email='test@example.org', user=user)
+
+    def identity_queries(self, url):
+        # the test client resets the queries when the request starts
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            response = self.client.get(url)
+        finally:
+            connection.use_debug_cursor = False
+        # the permissions checked by the templates are not identity
+        return response, [q['sql'] for q in connection.queries
+                          if 'auth_permission' not in q['sql']]
+
+    def test_profile_page(self):
+        self.assertTrue(self.client.login(username='test@example.org',
+                                          password='secret'))
+        # the user and its profile, the session is in the cookie
+        response, queries = self.identity_queries(reverse('profile'))
+        self.assertEqual(len(queries), 1)
+        self.assertTrue('cloud_profiles_profile' in queries[0])
+        self.assertEqual(response.context['profile'].email,
+                         'test@example.org')
+        self.client.logout()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('profile'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_removed_backend(self):
+        self.client.login(username='test@example.org', password='secret')
+        with self.settings(AUTHENTICATION_BACKENDS=(
+                'cloud_profiles.backend.X509Backend',)):
+            response = self.client.get(reverse('profile'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_update_cached_profile(self):
+        backend.dn_cache.clear()
+        backend.user_cache.clear()
+        Profile.objects.update(user_dn='/CN=test')
+        self.assertTrue(self.client.login(user_dn='/CN=test'))
+        self.client.get(reverse('profile'))
+        # activated by another process, the cached profile is stale
+        Profile.objects.update(status=Profile.VALID)
+        self.client.post(reverse('profile-update'), {
+            'name': 'New', 'phone': '0', 'institution': 'IFCA',
+            'country': 'ES'})
+        p = Profile.objects.get()
+        self.assertEqual((p.name, p.status), ('New', Profile.VALID))
+
+
+class ProfileListTest(TestCase):
+    def setUp(self):
+        for i in range(7):
+            Profile.objects.create(email='user%d@example.org' % i,
+                                   country='PT' if i % 2 else 'ES')
+
+    def get_context(self, **params):
+        view = ProfileList(page_size=2)
+        view.request = RequestFactory().get('/', params)
+        view.object_list = view.get_queryset()
+        return view.get_context_data(object_list=view.object_list)
+
+    def test_pages(self):
+        ctx = self.get_context(country='ES')
+        self.assertEqual([p.email for p in ctx['profiles']],
+                         ['user0@example.org', 'user2@example.org'])
+        self.assertEqual(ctx['prev_before'], None)
+        ctx = self.get_context(country='ES', after=ctx['next_after'])
+        self.assertEqual([p.email for p in ctx['profiles']],
+                         ['user4@example.org', 'user6@example.org'])
+        self.assertEqual(ctx['next_after'], None)
+        ctx = self.get_context(country='ES', before=ctx['prev_before'])
+        self.assertEqual([p.email for p in ctx['profiles']],
+                         ['user0@example.org', 'user2@example.org'])
+        self.assertEqual(ctx['prev_before'], None)
+
+
+@override_settings(
+    CLOUD_PROFILES_LDAP_INITIALIZE='cloud_profiles.fake_ldap.initialize',
+    CLOUD_PROFILES_LDAP_BASE_DN='o=cloud,dc=ibergrid,dc=eu',
+    CLOUD_PROFILES_LDAP_PAGE_SIZE=2)
+class FakeLDAPTestCase(TestCase):
+    def setUp(self):
+        fake_ldap.directory.reset()
+        ldap_users.get_servers().reset()
+
+    def tearDown(self):
+        fake_ldap.directory.sizelimit = 0
+
+
+class LDAPUsersTest(FakeLDAPTestCase):
+    dn = 'uid=%s,ou=users,c=es,o=cloud,dc=ibergrid,dc=eu'
+
+    def test_create_and_list(self):
+        for i in range(5):
+            ldap_users.create_user(self.dn % i, u'user%d' % i, u'User', i)
+        # more entries than the sizelimit, but paged
+        fake_ldap.directory.sizelimit = 3
+        emails = [u['email'] for u in list(ldap_users.iter_users())]
+        self.assertEqual(sorted(emails), ['user%d' % i for i in range(5)])
+
+    def create(self, n):
+        for i in range(n):
+            fake_ldap.directory.add(self.dn % i, [
+                ('uid', 'user%d' % i), ('cn', 'User'),
+                ('objectClass', 'account')])
+
+    @override_settings(CLOUD_PROFILES_LDAP_PAGE_SIZE=2)
+    def test_paged_search(self):
+        self.create(5)
+        fake_ldap.directory.sizelimit = 3
+        # the search without paging hits the sizelimit
+        with ldap_users.ldap_connection() as conn:
+            self.assertRaises(ldap.SIZELIMIT_EXCEEDED, conn.search_s,
+                              'o=cloud,dc=ibergrid,dc=eu',
+                              ldap.SCOPE_SUBTREE, '(objectClass=account)')
+        searches = fake_ldap.directory.ops['search']
+        emails = [u['email'] for u in ldap_users.iter_users()]
+        self.assertEqual(sorted(emails), ['user%d' % i for i in range(5)])
+        # pages of CLOUD_PROFILES_LDAP_PAGE_SIZE entries
+        self.assertEqual(fake_ldap.directory.ops['search'] - searches, 3)
+        searches = fake_ldap.directory.ops['search']
+        self.assertEqual(len(list(ldap_users.iter_users(page_size=5))), 5)
+        self.assertEqual(fake_ldap.directory.ops['search'] - searches, 1)
+
+    def test_paged_search_empty(self):
+        self.assertEqual(list(ldap_users.iter_users(page_size=2)), [])
+
+    def test_passwords(self):
+        ldap_users.create_user(self.dn % 0, u'user0', u'User', 0)
+        self.assertFalse(ldap_users.check_user_password(self.dn % 0, 'pw'))
+        ldap_users.reset_user_password(self.dn % 0, 'pw')
+        self.assertTrue(ldap_users.check_user_password(self.dn % 0, 'pw'))
+        ldap_users.change_user_password(self.dn % 0, 'pw', 'new')
+        self.assertTrue(ldap_users.check_user_password(self.dn % 0, 'new'))
+
+    def test_delete(self):
+        ldap_users.create_user(self.dn % 0, u'user0', u'User', 0)
+        ldap_users.delete_user(self.dn % 0)
+        self.assertEqual(list(ldap_users.iter_users()), [])
+        self.assertEqual(DirectoryAccount.objects.count(), 0)
+
+
+@override_settings(
+    CLOUD_PROFILES_LDAP_SERVERS=[
+        {'uri': 'ldap://master', 'role': 'master'},
+        {'uri': 'ldap://replica1', 'role': 'replica'},
+        {'uri': 'ldap://replica2', 'role': 'replica'}],
+    CLOUD_PROFILES_LDAP_BREAKER_MIN_CALLS=1)
+class LDAPFailoverTest(FakeLDAPTestCase):
+    dn = 'uid=user,ou=users,c=es,o=cloud,dc=ibergrid,dc=eu'
+
+    def test_roles(self):
+        servers = ldap_users.get_servers()
+        for i in range(10):
+            self.assertEqual(servers.candidates(write=True)[0].uri,
+                             'ldap://master')
+            self.assertTrue(servers.candidates(write=False)[0].uri
+                            .startswith('ldap://replica'))
+
+    def test_failover(self):
+        fake_ldap.directory.down.update(['ldap://replica1', 'ldap://replica2'])
+        ldap_users.create_user(self.dn, u'user', u'User', 1)
+        self.assertEqual(len(list(ldap_users.iter_users())), 1)
+        stats = dict((s['uri'], s) for s in ldap_users.server_stats())
+        self.assertEqual(stats['ldap://replica1']['state'], 'open')
+        self.assertEqual(stats['ldap://replica2']['state'], 'open')
+        self.assertEqual(stats['ldap://master']['state'], 'closed')
+        # ejected replicas are not tried until the cool down ends
+        candidates = ldap_users.get_servers().candidates(write=False)
+        self.assertEqual([s.uri for s in candidates], ['ldap://master'])
+
+    def test_master_down(self):
+        fake_ldap.directory.down.add('ldap://master')
+        self.assertRaises(ldap.SERVER_DOWN, ldap_users.create_user,
+                          self.dn, u'user', u'User', 1)
+        # fails fast without trying to connect
+        binds = fake_ldap.directory.ops['bind']
+        self.assertRaises(CircuitOpen, ldap_users.create_user,
+                          self.dn, u'user', u'User', 1)
+        self.assertEqual(fake_ldap.directory.ops['bind'], binds)
+
+
+class CircuitBreakerTest(TestCase):
+    def test_error_rate(self):
+        breaker = CircuitBreaker(window=4, min_calls=4, error_rate=0.5,
+                                 cooldown=10)
+        for ok in (True, False, True):
+            breaker.record(ok, now=100)
+        self.assertEqual(breaker.state(100), 'closed')
+        breaker.record(False, now=100)
+        self.assertEqual(breaker.state(105), 'open')
+        self.assertFalse(breaker.allows(105))
+        # after the cool down a failure opens it again...
+        self.assertEqual(breaker.state(110), 'half-open')
+        breaker.record(False, now=110)
+        self.assertEqual(breaker.state(115), 'open')
+        # ...and a success closes it
+        breaker.record(True, now=120)
+        self.assertEqual(breaker.state(120), 'closed')
+        self.assertEqual(breaker.opens, 2)
+
+
+class DeadlineTest(FakeLDAPTestCase):
+    dn = 'uid=user,ou=users,c=es,o=cloud,dc=ibergrid,dc=eu'
+
+    def tearDown(self):
+        deadlines.clear()
+        fake_ldap.directory.latency = 0
+        super(DeadlineTest, self).tearDown()
+
+    def test_operation_timeout(self):
+        ldap_users.create_user(self.dn, u'user', u'User', 1)
+        fake_ldap.directory.latency = {'search': 0.2}
+        deadlines.start(1)
+        with self.settings(CLOUD_PROFILES_LDAP_TIMEOUT=0.05):
+            self.assertRaises(ldap.TIMEOUT, list, ldap_users.iter_users())
+        stats = ldap_users.server_stats()
+        self.assertEqual(stats[0]['timeouts'], 1)
+
+    def test_middleware(self):
+        middleware = RequestDeadlineMiddleware()
+        request = RequestFactory().get('/')
+        with self.settings(CLOUD_PROFILES_REQUEST_BUDGET=10):
+            middleware.process_request(request)
+        self.assertTrue(0 < deadlines.remaining() <= 10)
+        middleware.process_response(request, None)
+        self.assertEqual(deadlines.remaining(), None)
+
+    def test_budget_spent(self):
+        deadlines.start(-1)
+        self.assertRaises(ldap_users.DeadlineExceeded,
+                          list, ldap_users.iter_users())
+        self.assertEqual(fake_ldap.directory.ops['search'], 0)
+        self.assertTrue(ldap_users.deadline_stats()['exceeded'] > 0)
+
+
+class ExportTest(FakeLDAPTestCase):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        for i in range(3):
+            Profile.objects.create(email='user%d@example.org' % i,
+                                   name=u'Us\xe9r %d' % i, country='PT')
+        DirectoryAccount.objects.create(
+            dn='uid=user1@example.org,o=cloud,dc=ibergrid,dc=eu',
+            email='user1@example.org', uid_number=7)
+
+    def test_profiles_csv(self):
+        lines = list(export.export_profiles('csv'))
+        self.assertEqual(len(lines), 4)
+        rows = list(csv.DictReader(lines))
+        self.assertEqual(rows[0]['name'], u'Us\xe9r 0'.encode('utf-8'))
+        self.assertEqual(rows[1]['uid_number'], '7')
+        self.assertEqual(rows[2]['ldap_dn'], '')
+
+    def test_profiles_chunks(self):
+        # two chunks of a profiles and an accounts query, and the last
+        # empty chunk
+        with self.assertNumQueries(5):
+            rows = list(export.iter_profiles(chunk_size=2))
+        self.assertEqual([r['email'] for r in rows],
+                         ['user%d@example.org' % i for i in range(3)])
+
+    def test_accounts_ldif(self):
+        ldap_users.create_user(
+            'uid=user0@example.org,o=cloud,dc=ibergrid,dc=eu',
+            u'user0@example.org', u'User', 5)
+        records = list(export.export_accounts('ldif'))
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0].startswith('dn: uid=user0@example.org,'))
+        self.assertTrue('uidNumber: 5\n' in records[0])
+
+
+class RegistrationTest(TestCase):
+    data = {'name': 'User', 'email': 'user@example.org', 'phone': '0',
+            'institution': 'IFCA', 'country': 'ES', 'research_area': 'r',
+            'description': 'd', 'resources': 'r'}
+
+    def writes(self, func, *args, **kwargs):
+        # the test client resets the queries when the request starts
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            func(*args, **kwargs)
+        finally:
+            connection.use_debug_cursor = False
+        return [q['sql'] for q in connection.queries
+                if q['sql'].split(None, 1)[0].upper() in
+                ('INSERT', 'UPDATE', 'DELETE')]
+
+    def test_register(self):
+        writes = self.writes(self.client.post, reverse('registration'),
+                             self.data, SSL_CLIENT_S_DN='/CN=User')
+        # the user, the profile and the queued confirmation email
+        self.assertEqual(len(writes), 3)
+        p = Profile.objects.get(email='user@example.org')
+        self.assertEqual(p.user_dn, '/CN=User')
+        self.assertTrue(p.confirmation_key and p.password_key)
+        self.assertFalse(p.user.is_active)
+        self.assertFalse(p.user.has_usable_password())
+
+    def test_existing_user(self):
+        User.objects.create(username='user@example.org')
+        writes = self.writes(Profile.objects.new_profile,
+                             email='user@example.org')
+        self.assertEqual(len(writes), 1)
+
+
+class RegistrationRollbackTest(TransactionTestCase):
+    def test_mail_failure(self):
+        def fail(*args, **kwargs):
+            raise ValueError('no queue')
+        queue_mail = views.queue_mail
+        views.queue_mail = fail
+        try:
+            self.assertRaises(ValueError, self.client.post,
+                              reverse('registration'), RegistrationTest.data)
+        finally:
+            views.queue_mail = queue_mail
+        self.assertEqual(Profile.objects.count(), 0)
+        self.assertEqual(User.objects.count(), 0)
+
+
+class TokenTest(TestCase):
+    def link(self, path):
+        body = QueuedMail.objects.latest('pk').body
+        return [l for l in body.split() if path in l][0].split(
+            'testserver', 1)[1]
+
+    def test_confirm_and_reset(self):
+        self.client.post(reverse('registration'), RegistrationTest.data)
+        p = Profile.objects.get()
+        url = self.link('/confirm/')
+        # only the hash is stored
+        self.assertEqual(p.confirmation_key,
+                         tokens.hash_token(url.rsplit('/', 1)[1]))
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, 'cloud_profiles/confirm_ok.html')
+        p = Profile.objects.get()
+        p.activate()
+        self.assertEqual(self.client.get(reverse(
+            'reset-password', args=[p.password_token])).status_code, 200)
+        with self.settings(CLOUD_PROFILES_TOKEN_TTL={'password': 0}):
+            self.assertEqual(self.client.get(reverse(
+                'reset-password', args=[p.password_token])).status_code, 404)
+            self.assertEqual(Profile.objects.purge_expired_tokens(), 1)
+        self.assertEqual(Profile.objects.get().password_key, '')
+
+    def test_collision(self):
+        p = Profile.objects.new_profile(email='user@example.org')
+        p.activate()
+        new_tokens = tokens.new_tokens
+        # the first draw repeats the tokens of the profile
+        drawn = [[(p.confirmation_token, p.confirmation_key),
+                  (p.password_token, p.password_key)]]
+
+        def draw(n):
+            return drawn.pop()[:n] if drawn else new_tokens(n)
+        tokens.new_tokens = draw
+        try:
+            keys = Profile.objects.new_tokens(2)
+        finally:
+            tokens.new_tokens = new_tokens
+        self.assertEqual(len(keys), 2)
+        self.assertFalse(set(h for t, h in keys) &
+                         set([p.confirmation_key, p.password_key]))
+
+    def test_resend_activation(self):
+        p = Profile.objects.new_profile(email='user@example.org')
+        User.objects.create_superuser('admin', 'admin@example.org', 'admin')
+        self.client.login(username='admin', password='admin')
+        url = reverse('resend-activation', args=[p.pk])
+        # not activated yet
+        self.client.get(url)
+        self.assertEqual(QueuedMail.objects.count(), 0)
+        p.activate()
+        Profile.objects.update(password_issued=timezone.now() -
+                               timedelta(days=30))
+        self.assertEqual(self.client.get(reverse(
+            'reset-password', args=[p.password_token])).status_code, 404)
+        self.assertContains(self.client.get(reverse('profiles')), url)
+        self.assertRedirects(self.client.get(url), reverse('profiles'))
+        self.assertEqual(self.client.get(self.link('/reset-password/'))
+                         .status_code, 200)
+
+    def test_new_tokens(self):
+        keys = tokens.new_tokens(100)
+        self.assertEqual(len(set(t for t, h in keys)), 100)
+        self.assertTrue(all(len(t) == 32 and '=' not in t
+                            for t, h in keys))
+
+
+@override_settings(CLOUD_PROFILES_THROTTLE_LIMITS={
+    'registration': {'ip': (3, 60), 'email': (1, 60)},
+    'confirm': {'ip': (2, 60)}})
+class ThrottleTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_sliding_window(self):
+        self.assertEqual(throttle.hit('k', 2, 60, now=60), 0)
+        self.assertEqual(throttle.hit('k', 2, 60, now=90), 0)
+        self.assertEqual(throttle.hit('k', 2, 60, now=100), 20)
+        # the previous window weighs 2 * 0.75
+        self.assertEqual(throttle.hit('k', 2, 60, now=135), 0)
+        # and then 2 * 0.66 + 1, until it weighs less than 1 at 150
+        self.assertEqual(throttle.hit('k', 2, 60, now=140), 10)
+        self.assertEqual(throttle.hit('k', 2, 60, now=151), 0)
+
+    def test_confirm(self):
+        url = reverse('confirm', args=['nokey'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get(url)
+        finally:
+            connection.use_debug_cursor = False
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(0 < int(response['Retry-After']) <= 60)
+        # refused before looking up the profile
+        self.assertEqual(connection.queries, [])
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.1')
+                         .status_code, 404)
+
+    def test_registration_email(self):
+        data = dict(RegistrationTest.data)
+        url = reverse('registration')
+        # loading the form is not counted
+        for i in range(4):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(self.client.post(url, data).status_code, 429)
+        data['email'] = 'other@example.org'
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(len(mail.outbox) + QueuedMail.objects.count(), 2)
+
+
+@override_settings(
+    CLOUD_PROFILES_TIMING_SAMPLE_RATE=1,
+    MIDDLEWARE_CLASSES=(
+        'cloud_profiles.middleware.TimingMiddleware',
+        'django.middleware.common.CommonMiddleware',
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware'))
+class TimingMiddlewareTest(TestCase):
+    def timings(self, response):
+        timings = {}
+        for entry in response['Server-Timing'].split(', '):
+            params = entry.split(';')
+            timings[params[0]] = params[1:]
+        return timings
+
+    def test_timings(self):
+        response = self.client.get(reverse('registration'))
+        self.assertTrue('template' in self.timings(response))
+        response = self.client.post(reverse('registration'),
+                                    RegistrationTest.data)
+        timings = self.timings(response)
+        self.assertEqual(timings['mail'][1], 'desc="1 calls"')
+        self.assertTrue('db' in timings and 'total' in timings)
+        self.assertFalse(connection.use_debug_cursor)
+
+    def test_sampling(self):
+        with self.settings(CLOUD_PROFILES_TIMING_SAMPLE_RATE=0):
+            response = self.client.get(reverse('registration'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+
+class MetricsTest(TestCase):
+    def value(self, text, line):
+        for l in text.splitlines():
+            if l.startswith(line + ' '):
+                return float(l.split()[-1])
+        return None
+
+    def test_render(self):
+        before = self.value(metrics.render(),
+                            'ibercloud_profile_events_total'
+                            '{event="registration"}') or 0
+        Profile.objects.new_profile(email='user@example.org')
+        metrics.observe('ibercloud_ldap_operation_seconds', 0.003,
+                        op='test')
+        queue_mail('s', 'b', 'from@example.org', ['to@example.org'])
+        text = metrics.render()
+        self.assertEqual(self.value(text, 'ibercloud_profile_events_total'
+                                          '{event="registration"}'),
+                         before + 1)
+        self.assertEqual(self.value(text, 'ibercloud_mail_queue_depth'), 1)
+        self.assertEqual(self.value(
+            text, 'ibercloud_ldap_operation_seconds_bucket'
+                  '{op="test",le="0.005"}'), 1)
+        self.assertEqual(self.value(
+            text, 'ibercloud_ldap_operation_seconds_bucket'
+                  '{op="test",le="0.0025"}'), 0)
+
+    def test_processes(self):
+        path = tempfile.mkdtemp()
+        try:
+            # a process that is gone
+            with open(os.path.join(path, '999999999.json'), 'w') as f:
+                json.dump({'counters': [['ibercloud_logins_total',
+                                         {'backend': 'x509',
+                                          'outcome': 'success'}, 5]],
+                           'histograms': [],
+                           'gauges': [['ibercloud_ldap_pool_size',
+                                       {'server': 'ldap://gone'}, 4]]}, f)
+            with self.settings(CLOUD_PROFILES_METRICS_DIR=path):
+                before = self.value(metrics.render(),
+                                    'ibercloud_logins_total'
+                                    '{backend="x509",outcome="success"}')
+                metrics.inc('ibercloud_logins_total', backend='x509',
+                            outcome='success')
+                text = metrics.render()
+            self.assertEqual(self.value(text, 'ibercloud_logins_total'
+                                              '{backend="x509",'
+                                              'outcome="success"}'),
+                             before + 1)
+            self.assertTrue(before >= 5)
+            self.assertEqual(self.value(text, 'ibercloud_ldap_pool_size'
+                                              '{server="ldap://gone"}'),
+                             None)
+            self.assertTrue(os.path.exists(
+                os.path.join(path, '%d.json' % os.getpid())))
+        finally:
+            shutil.rmtree(path)
+
+    def test_concurrent_flush(self):
+        path = tempfile.mkdtemp()
+
+        def flush():
+            for i in range(20):
+                metrics.flush()
+        try:
+            with self.settings(CLOUD_PROFILES_METRICS_DIR=path):
+                threads = [threading.Thread(target=flush) for i in range(8)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            with open(os.path.join(path, '%d.json' % os.getpid())) as f:
+                self.assertTrue('counters' in json.load(f))
+            self.assertEqual(os.listdir(path), ['%d.json' % os.getpid()])
+        finally:
+            shutil.rmtree(path)
+
+    def test_logins(self):
+        lines = ['ibercloud_logins_total{backend="model",outcome="success"}',
+                 'ibercloud_logins_total{backend="password",'
+                 'outcome="failure"}']
+        before = [self.value(metrics.render(), l) or 0 for l in lines]
+        User.objects.create_user('user', 'user@example.org', 'pw')
+        self.client.login(username='user', password='pw')
+        self.client.login(username='user', password='bad')
+        text = metrics.render()
+        self.assertEqual([self.value(text, l) for l in lines],
+                         [before[0] + 1, before[1] + 1])
+
+    def test_view(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('# TYPE ibercloud_logins_total counter' in
+                        response.content)
+        response = self.client.get(reverse('metrics'),
+                                   REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+
+class WarmupTest(TestCase):
+    @override_settings(TEMPLATE_LOADERS=(
+        ('django.template.loaders.cached.Loader',
+         ('django.template.loaders.filesystem.Loader',
+          'django.template.loaders.app_directories.Loader')),))
+    def test_warm_templates(self):
+        names = warmup.template_names()
+        self.assertTrue('cloud_profiles/activation_email.txt' in names)
+        self.assertTrue('base.html' in names)
+        self.assertEqual(warmup.warm_templates(), len(names))
+        cached = loader.template_source_loaders[0].template_cache
+        self.assertTrue('cloud_profiles/registration_email.txt' in cached)
+
+
+class ImportTest(TestCase):
+    def test_bulk_new_profiles(self):
+        Profile.objects.new_profile(email='old@example.org')
+        User.objects.create(username='user@example.org')
+        rows = [{'email': 'old@example.org', 'name': 'Old'},
+                {'email': 'user@example.org', 'name': 'User'},
+                {'email': 'new@example.org', 'name': 'New'},
+                {'email': 'new@example.org', 'name': 'Dup'}]
+        created, skipped = Profile.objects.bulk_new_profiles(rows)
+        self.assertEqual((created, skipped), (2, 2))
+        p = Profile.objects.get(email='new@example.org')
+        self.assertEqual(p.name, 'New')
+        self.assertFalse(p.user.is_active)
+        self.assertFalse(p.user.has_usable_password())
+        self.assertTrue(p.confirmation_key and p.password_key)
+        # the existing user is reused
+        self.assertEqual(User.objects.filter(
+            username='user@example.org').count(), 1)
+        self.assertEqual(Profile.objects.get(
+            email='user@example.org').user.username, 'user@example.org')
+
+    def test_round_trip(self):
+        Profile.objects.create(email='user@example.org', name=u'Us\xe9r',
+                               institution='IFCA', country='PT')
+        csv_file = StringIO(''.join(export.export_profiles('csv')))
+        ldif_file = StringIO(''.join(export.export_profiles('ldif')))
+        for rows in (readers.read_csv(csv_file),
+                     readers.read_ldif(ldif_file)):
+            row = list(rows)[0]
+            self.assertEqual(row['email'], 'user@example.org')
+            self.assertEqual(row['name'], u'Us\xe9r')
+            self.assertEqual(row['country'], 'PT')
+
+    def test_init_profiles(self):
+        call_command('import_profiles', INIT_PROFILES, verbosity=0)
+        self.assertEqual(Profile.objects.filter(
+            status=Profile.CONFIRMED).count(), 18)
+
+
+class ActivationTest(FakeLDAPTestCase):
+    def test_activate_profiles(self):
+        for i in range(3):
+            Profile.objects.new_profile(email='user%d@example.org' % i,
+                                        status=Profile.CONFIRMED)
+        Profile.objects.filter(email='user2@example.org').update(
+            status=Profile.VALID)
+        results = Profile.objects.activate_profiles(Profile.objects.all())
+        self.assertEqual(sorted(results.values()),
+                         [None, None, 'profile is not pending activation'])
+        self.assertEqual(Profile.objects.filter(status=Profile.VALID,
+                                                user__is_active=True).count(),
+                         2)
+        self.assertEqual(fake_ldap.directory.ops['add'], 0)
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (2, 0))
+        self.assertEqual(fake_ldap.directory.ops['add'], 2)
+
+
+@override_settings(TEMPLATE_CONTEXT_PROCESSORS=(
+    'django.contrib.auth.context_processors.auth',
+    'django.contrib.messages.context_processors.messages'))
+class ActivationViewTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.org', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def test_activate_message(self):
+        p = Profile.objects.new_profile(email='user@example.org')
+        response = self.client.get(reverse('activate', args=[p.pk]),
+                                   follow=True)
+        message = list(response.context['messages'])[0].message
+        self.assertTrue('queued' in message)
+        self.assertTrue(reverse(
+            'admin:cloud_profiles_directoryoperation_changelist') in message)
+
+    def test_activate_twice(self):
+        p = Profile.objects.new_profile(email='user@example.org')
+        self.client.get(reverse('activate', args=[p.pk]))
+        key = Profile.objects.get(pk=p.pk).password_key
+        response = self.client.get(reverse('activate', args=[p.pk]),
+                                   follow=True)
+        self.assertContains(response, 'Unable to activate user@example.org')
+        self.assertEqual(Profile.objects.get(pk=p.pk).password_key, key)
+        self.assertEqual(QueuedMail.objects.count(), 1)
+        self.assertEqual(DirectoryOperation.objects.count(), 1)
+
+    def create_profiles(self):
+        for i, status in enumerate((Profile.CREATED, Profile.CONFIRMED,
+                                    Profile.VALID)):
+            Profile.objects.new_profile(email='user%d@example.org' % i,
+                                        status=status)
+        return Profile.objects.order_by('pk')
+
+    def assertActivated(self, emails):
+        self.assertEqual(sorted(Profile.objects.filter(
+            status=Profile.VALID, user__is_active=True).values_list(
+            'email', flat=True)), sorted(emails))
+        self.assertEqual(sorted(m.recipients for m in
+                                QueuedMail.objects.all()), sorted(emails))
+        self.assertEqual(sorted(json.loads(o.data)['email'] for o in
+                                DirectoryOperation.objects.filter(
+                                    op=ldap_users.CREATE)), sorted(emails))
+
+    def test_bulk_activate(self):
+        profiles = self.create_profiles()
+        response = self.client.post(reverse('activate-bulk'), {
+            'profile': [p.pk for p in profiles]}, follow=True)
+        self.assertActivated(['user0@example.org', 'user1@example.org'])
+        # the valid profile is skipped and reported
+        self.assertContains(response, '2 profiles activated')
+        self.assertContains(response, 'Unable to activate user2@example.org')
+        self.assertEqual(Profile.objects.get(
+            email='user2@example.org').password_issued, None)
+
+    def test_admin_action(self):
+        profiles = self.create_profiles()
+        self.client.post(
+            reverse('admin:cloud_profiles_profile_changelist'),
+            {'action': 'activate',
+             '_selected_action': [p.pk for p in profiles]})
+        self.assertActivated(['user0@example.org', 'user1@example.org'])
+
+
+@override_settings(CLOUD_PROFILES_UID_BLOCK_SIZE=3)
+class UidTest(TestCase):
+    def setUp(self):
+        uids.reset()
+
+    def tearDown(self):
+        uids.reset()
+
+    def test_blocks(self):
+        # after the base + pk uids of the existing profiles
+        base = 1000000 + Profile.objects.create(email='old@example.org').pk
+        self.assertEqual(uids.allocate('ES', 2), [base + 1, base + 2])
+        # taken in the directory
+        DirectoryAccount.objects.create(dn='uid=x', email='x',
+                                        uid_number=base + 5)
+        self.assertEqual(uids.allocate('ES', 2), [base + 3, base + 4])
+        # left in the block of the process
+        with self.assertNumQueries(0):
+            self.assertEqual(uids.allocate('ES'), [base + 6])
+        self.assertEqual(UidSequence.objects.get(base=1000000).next_uid,
+                         base + 8)
+        self.assertEqual(uids.allocate('PT'), [base + 1000001])
+
+    def test_activate_profiles(self):
+        for i, country in enumerate(('ES', 'PT', 'ES')):
+            Profile.objects.new_profile(email='user%d@example.org' % i,
+                                        country=country)
+        Profile.objects.activate_profiles(Profile.objects.all())
+        numbers = dict(Profile.objects.values_list('email', 'uid_number'))
+        self.assertEqual(len(set(numbers.values())), 3)
+        self.assertTrue(2000000 < numbers['user1@example.org'] < 3000000)
+        for o in DirectoryOperation.objects.all():
+            data = json.loads(o.data)
+            self.assertEqual(data['uid'], numbers[data['email']])
+
+
+class DirectoryJournalTest(FakeLDAPTestCase):
+    def test_profile_lifecycle(self):
+        p = Profile.objects.new_profile(email='user@example.org',
+                                        name=u'User')
+        p.activate()
+        p.password_reset('secret')
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (2, 0))
+        self.assertTrue(p.check_password('secret'))
+        p.delete()
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (1, 0))
+        self.assertFalse(p.check_password('secret'))
+        self.assertEqual(fake_ldap.directory.entries, {})
+
+    def test_idempotent(self):
+        dn = 'uid=a,o=cloud,dc=ibergrid,dc=eu'
+        data = {'email': u'a', 'name': u'A', 'uid': 1}
+        results = ldap_users.apply_operations([
+            (ldap_users.CREATE, dn, data),
+            (ldap_users.CREATE, dn, data),
+            (ldap_users.DELETE, 'uid=b,o=cloud,dc=ibergrid,dc=eu', {}),
+        ])
+        self.assertEqual(results, [None, None, None])
+
+    def test_failed_entry(self):
+        dn = 'uid=a,o=cloud,dc=ibergrid,dc=eu'
+        DirectoryOperation.objects.enqueue(ldap_users.RESET_PASSWORD, dn,
+                                           password='x')
+        DirectoryOperation.objects.enqueue(ldap_users.DELETE, dn)
+        with self.settings(CLOUD_PROFILES_LDAP_OPS_MAX_ATTEMPTS=1):
+            self.assertEqual(DirectoryOperation.objects.apply_pending(),
+                             (0, 2))
+        self.assertEqual(DirectoryOperation.objects.filter(
+            status=DirectoryOperation.FAILED).count(), 2)
+        self.assertEqual(DirectoryOperation.objects.requeue(), 2)
+        self.assertEqual(DirectoryOperation.objects.get(
+            op=ldap_users.DELETE).attempts, 0)
+        # and fail again, the delete after the password reset of its entry
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (0, 2))
+
+    def test_retry_delay(self):
+        dn = 'uid=a,o=cloud,dc=ibergrid,dc=eu'
+        DirectoryOperation.objects.enqueue(ldap_users.RESET_PASSWORD, dn,
+                                           password='x')
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (0, 1))
+        # later operations on the entry wait with it, the others do not
+        DirectoryOperation.objects.enqueue(ldap_users.DELETE, dn)
+        DirectoryOperation.objects.enqueue(
+            ldap_users.CREATE, 'uid=b,o=cloud,dc=ibergrid,dc=eu',
+            email=u'b', name=u'B', uid=2)
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (1, 0))
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (0, 0))
+        DirectoryOperation.objects.update(next_attempt=timezone.now())
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (0, 2))
+
+    def test_outage(self):
+        p = Profile.objects.new_profile(email='user@example.org',
+                                        name=u'User')
+        p.activate()
+        fake_ldap.directory.down.add(settings.CLOUD_PROFILES_LDAP_SERVER_URI)
+        # many more runs than attempts, the last ones with the circuit open
+        for i in range(10):
+            self.assertRaises(ldap.SERVER_DOWN,
+                              DirectoryOperation.objects.apply_pending)
+        o = DirectoryOperation.objects.get()
+        self.assertEqual((o.status, o.attempts),
+                         (DirectoryOperation.PENDING, 0))
+        self.assertRaises(CommandError, call_command, 'apply_directory_ops',
+                          verbosity=0)
+        fake_ldap.directory.down.clear()
+        ldap_users.get_servers().reset()
+        self.assertEqual(DirectoryOperation.objects.apply_pending(), (1, 0))
+
+
+class DirectorySyncTest(FakeLDAPTestCase):
+    dn = 'uid=%s,ou=users,c=es,o=cloud,dc=ibergrid,dc=eu'
+
+    def add(self, uid):
+        fake_ldap.directory.add(self.dn % uid, [('uid', uid), ('cn', uid),
+                                                ('uidNumber', '1'),
+                                                ('objectClass', 'account')])
+
+    def test_sync(self):
+        for uid in ('a', 'b', 'c'):
+            self.add(uid)
+        self.assertEqual(DirectoryAccount.objects.sync(), (3, 0, 0))
+        self.add('d')
+        fake_ldap.directory.modify(self.dn % 'a',
+                                   [(ldap.MOD_REPLACE, 'cn', 'A')])
+        fake_ldap.directory.delete(self.dn % 'b')
+        self.assertEqual(DirectoryAccount.objects.sync(), (1, 1, 0))
+        self.assertEqual(DirectoryAccount.objects.get(email='a').name, 'A')
+        self.assertEqual(DirectoryAccount.objects.sync(full=True), (0, 0, 1))
+        self.assertEqual(DirectoryAccount.objects.count(), 3)
+
+    def test_incremental(self):
+        for uid in ('a', 'b'):
+            self.add(uid)
+        DirectoryAccount.objects.sync()
+        latest = DirectoryAccount.objects.get(email='b').modify_timestamp
+        self.add('c')
+        filters = []
+        search_ext = fake_ldap.FakeLDAPObject.search_ext
+
+        def spy(conn, base, scope, filterstr=None, *args, **kwargs):
+            filters.append(filterstr)
+            return search_ext(conn, base, scope, filterstr, *args, **kwargs)
+        fake_ldap.FakeLDAPObject.search_ext = spy
+        try:
+            self.assertEqual(DirectoryAccount.objects.sync(), (1, 0, 0))
+        finally:
+            fake_ldap.FakeLDAPObject.search_ext = search_ext
+        # every page of the search
+        self.assertEqual(set(filters), set(['(&(objectClass=account)'
+                                            '(modifyTimestamp>=%s))' %
+                                            latest]))
+
+    def test_portal_accounts_only(self):
+        # written by the portal, not read from the directory yet
+        ldap_users.create_user(self.dn % 'a', u'a', u'A', 1)
+        DirectoryAccount.objects.create(dn=self.dn % 'gone', email='gone')
+        self.assertEqual(DirectoryAccount.objects.sync(), (0, 1, 1))
+        self.assertTrue(DirectoryAccount.objects.get().modify_timestamp)
+
+    def test_write_through(self):
+        ldap_users.create_user(self.dn % 'a', u'a', u'A', 1)
+        self.assertEqual(DirectoryAccount.objects.get().uid_number, 1)
+        ldap_users.delete_user(self.dn % 'a')
+        self.assertEqual(DirectoryAccount.objects.count(), 0)
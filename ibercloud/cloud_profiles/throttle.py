@@ -0,0 +1,122 @@
+#
+# Rate limits of the public views (registration, confirmation and password
+# reset) per client address and per email, kept in the default cache so
+# that all the processes share them.
+#
+# Each limit is a sliding window approximated with two fixed window
+# counters: the count of the previous window, weighted by the part of it
+# that still overlaps the sliding window, plus the count of the current
+# one. A check is a single get_many and an add or incr, whatever the
+# number of requests.
+#
+
+import functools
+import hashlib
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from cloud_profiles import metrics
+
+# scope -> {kind: (requests, seconds)}, kind is 'ip' or 'email'
+DEFAULT_LIMITS = {
+    'registration': {'ip': (60, 3600), 'email': (5, 3600)},
+    'confirm': {'ip': (60, 3600)},
+    'reset-password': {'ip': (60, 3600)},
+}
+
+
+def get_limits(scope):
+    limits = getattr(settings, 'CLOUD_PROFILES_THROTTLE_LIMITS',
+                     DEFAULT_LIMITS)
+    return limits.get(scope, {})
+
+
+def _key(scope, kind, ident, window):
+    # emails and IPv6 addresses are hashed to get safe memcached keys
+    digest = hashlib.md5(ident.encode('utf-8')).hexdigest()
+    return 'throttle:%s:%s:%s:%d' % (scope, kind, digest, window)
+
+
+def hit(key, limit, period, now=None):
+    """
+    Counts a request for `key` if it is within `limit` requests in the
+    last `period` seconds. Returns 0 if it was, or the seconds to wait
+    before retrying if it was not.
+    """
+    if now is None:
+        now = time.time()
+    window = int(now // period)
+    elapsed = now - window * period
+    current, previous = '%s:%d' % (key, window), '%s:%d' % (key, window - 1)
+    counts = cache.get_many([current, previous])
+    count = counts.get(current, 0)
+    weight = (period - elapsed) / float(period)
+    if counts.get(previous, 0) * weight + count >= limit:
+        if count >= limit or not counts.get(previous):
+            wait = period - elapsed
+        else:
+            # time for the previous window to weigh less than the room left
+            wait = period - elapsed - \
+                (limit - count) * float(period) / counts[previous]
+        return max(1, int(math.ceil(wait)))
+    # kept until the end of the next window, where it is the previous one
+    if not cache.add(current, 1, period * 2):
+        try:
+            cache.incr(current)
+        except ValueError:
+            # expired between the add and the incr
+            cache.set(current, 1, period * 2)
+    return 0
+
+
+def client_ip(request):
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def check(request, scope):
+    """
+    Counts the request against the limits of `scope`, returns 0 or the
+    seconds to wait if any of them is exceeded
+    """
+    idents = {'ip': client_ip(request)}
+    if request.method == 'POST' and request.POST.get('email'):
+        idents['email'] = request.POST['email'].strip().lower()
+    for kind, (limit, period) in sorted(get_limits(scope).items()):
+        ident = idents.get(kind)
+        if not ident:
+            continue
+        wait = hit(_key(scope, kind, ident, period), limit, period)
+        if wait:
+            metrics.inc('ibercloud_throttled_total', scope=scope, kind=kind)
+            return wait
+    return 0
+
+
+def too_many_requests(wait):
+    response = HttpResponse('Too many requests, try again later\n',
+                            status=429, content_type='text/plain')
+    response['Retry-After'] = str(wait)
+    return response
+
+
+def throttled(scope, methods=None):
+    """
+    Decorator of views that answers 429 to the requests over the limits of
+    `scope`, before the view does anything. Only the requests of
+    `methods` are counted, all of them by default.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if methods and request.method not in methods:
+                return view(request, *args, **kwargs)
+            wait = check(request, scope)
+            if wait:
+                return too_many_requests(wait)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
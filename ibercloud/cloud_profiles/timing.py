@@ -0,0 +1,63 @@
+#
+# Per request counts and time spent in each subsystem (db, ldap, ...),
+# collected by cloud_profiles.middleware.TimingMiddleware
+#
+
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+    def __init__(self):
+        self.started = time.time()
+        # subsystem -> [calls, seconds]
+        self.subsystems = {}
+
+    def add(self, name, elapsed, calls=1):
+        entry = self.subsystems.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += elapsed
+
+    def total(self):
+        return time.time() - self.started
+
+
+def start():
+    _local.timings = RequestTimings()
+    return _local.timings
+
+
+def stop():
+    timings = current()
+    _local.timings = None
+    return timings
+
+
+def current():
+    return getattr(_local, 'timings', None)
+
+
+def record(name, elapsed, calls=1):
+    """
+    Adds a call of `elapsed` seconds to `name` if the current request
+    is being timed
+    """
+    timings = current()
+    if timings is not None:
+        timings.add(name, elapsed, calls)
+
+
+@contextmanager
+def timed(name):
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.add(name, time.time() - start)
@@ -0,0 +1,56 @@
+#
+# Confirmation and password reset tokens. The users get a random URL safe
+# token and the profile only stores its sha256, which is looked up through
+# an index.
+#
+
+import base64
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+# 24 random bytes are 32 URL safe characters, without padding
+TOKEN_BYTES = 24
+
+
+def _encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip('=')
+
+
+def hash_token(token):
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).hexdigest()
+
+
+def new_tokens(n):
+    """
+    Returns `n` (token, hash) pairs, reading the random bytes of all of
+    them at once
+    """
+    data = os.urandom(n * TOKEN_BYTES)
+    tokens = [_encode(data[i:i + TOKEN_BYTES])
+              for i in range(0, len(data), TOKEN_BYTES)]
+    return [(t, hash_token(t)) for t in tokens]
+
+
+def new_token():
+    return new_tokens(1)[0]
+
+
+def get_ttl(kind):
+    """
+    Seconds a token is valid, kind is 'confirmation' or 'password'
+    """
+    ttl = getattr(settings, 'CLOUD_PROFILES_TOKEN_TTL', {})
+    return ttl.get(kind, 7 * 24 * 3600)
+
+
+def issued_after(kind, now=None):
+    """
+    Issue time of the oldest token of `kind` that is still valid
+    """
+    return (now or timezone.now()) - timedelta(seconds=get_ttl(kind))
@@ -0,0 +1,58 @@
+#
+# uidNumber allocation. Each country has a range of uids starting at its
+# base and a UidSequence row in the database with the next free one. Every
+# process reserves blocks of CLOUD_PROFILES_UID_BLOCK_SIZE uids, locking
+# the row once per block, and hands them out from memory. The uids left in
+# the block of a process when it exits are never used.
+#
+
+import threading
+
+from django.conf import settings
+
+# country -> first uid of its range
+BASES = {
+    'ES': 1000000,
+    'PT': 2000000,
+}
+DEFAULT_BASE = 9000000
+# uids of each range
+RANGE_SIZE = 1000000
+
+_lock = threading.Lock()
+# base -> uids reserved by this process and not handed out yet
+_blocks = {}
+
+
+def get_base(country):
+    return BASES.get(country, DEFAULT_BASE)
+
+
+def block_size():
+    return getattr(settings, 'CLOUD_PROFILES_UID_BLOCK_SIZE', 100)
+
+
+def allocate(country, n=1):
+    """
+    Returns `n` free uids of the range of the country, reserving a new
+    block if the one of the process runs out
+    """
+    # models imports this module
+    from cloud_profiles.models import UidSequence
+    base = get_base(country)
+    with _lock:
+        block = _blocks.setdefault(base, [])
+        if len(block) < n:
+            block.extend(UidSequence.objects.reserve(
+                base, max(n - len(block), block_size())))
+        uids = block[:n]
+        del block[:n]
+    return uids
+
+
+def reset():
+    """
+    Forgets the blocks of the process
+    """
+    with _lock:
+        _blocks.clear()
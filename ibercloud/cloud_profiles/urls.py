@@ -6,7 +6,9 @@ from cloud_profiles.views import (UserLogin, UserLogout, ProfileView,
                                   SelfProfileModify, ProfileModify,
                                   ProfileList, ProfileDel, RegisterProfile,
                                   ProfileConfirm, ProfileActivate,
-                                  ResetPassword, UserList)
+                                  ProfileBulkActivate,
+                                  ProfileResendActivation, ResetPassword,
+                                  UserList, ProfileExport, UserExport)
 
 # password change
 from django.contrib.auth.views import password_change
@@ -27,6 +29,8 @@ urlpatterns = patterns('',
          name='password_change'),
     # user profiles
     url(r'^profiles$', ProfileList.as_view(), name='profiles'),
+    url(r'^profiles/export$', ProfileExport.as_view(),
+        name='profiles-export'),
     url(r'^profile$', ProfileView.as_view(), name='profile'),
     url(r'^profile/(?P<pk>\w+)$', ProfileView.as_view(), name='profile'),
     url(r'^profile-update$', SelfProfileModify.as_view(),
@@ -45,6 +49,9 @@ urlpatterns = patterns('',
         name='confirm'),
     # activate profile
     url(r'^activate/(?P<pk>\w+)$', ProfileActivate.as_view(), name='activate'),
+    url(r'^activate$', ProfileBulkActivate.as_view(), name='activate-bulk'),
+    url(r'^resend-activation/(?P<pk>\w+)$',
+        ProfileResendActivation.as_view(), name='resend-activation'),
     #url(r'^activate/(?P<activation_key>(\w|-)+)$', ProfileActivate.as_view(),
     #    name='activate'),
     #url(r'^validation_fail$',
@@ -58,4 +65,5 @@ urlpatterns = patterns('',
         ResetPassword.as_view(), name='reset-password'),
     # list ldap users 
     url(r'^user-list$', UserList.as_view(), name='user-list'),
+    url(r'^user-list/export$', UserExport.as_view(), name='user-list-export'),
 )
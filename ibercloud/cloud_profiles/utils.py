@@ -0,0 +1,30 @@
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import transaction
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of up to `size` items of iterable
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+@contextmanager
+def commit_on_success():
+    """
+    transaction.commit_on_success that joins the transaction of the caller
+    if there is one. The nested block of Django would commit it on exit,
+    before the caller is done.
+    """
+    if transaction.is_managed():
+        yield
+    else:
+        with transaction.commit_on_success():
+            yield
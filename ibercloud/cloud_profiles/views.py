@@ -3,11 +3,14 @@
 #
 
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.core.mail import send_mail
+from django.contrib import messages
 from django.contrib.sites.models import RequestSite
-from django.http import HttpResponseRedirect
+from django.http import (HttpResponseRedirect, HttpResponseBadRequest,
+                         StreamingHttpResponse)
 from django.shortcuts import redirect, get_object_or_404
 from django.template import loader
+from django.utils.html import format_html
+from django.utils.http import urlencode
 
 # authentication
 from django.contrib.auth import authenticate, login, logout
@@ -17,15 +20,19 @@ from django.utils.decorators import method_decorator
 
 # Class based views
 from class_based_auth_views.views import LoginView, LogoutView
-from django.views.generic.base import RedirectView, TemplateView
+from django.views.generic.base import RedirectView, TemplateView, View
 from django.views.generic.list import ListView
 from django.views.generic.edit import FormView, UpdateView, DeleteView
 
-from cloud_profiles.models import Profile
+from cloud_profiles import export
+from cloud_profiles.mail import queue_mail, queue_mails
+from cloud_profiles.models import (Profile, DirectoryAccount,
+                                   DirectoryOperation, COUNTRIES)
+from cloud_profiles.throttle import throttled
 from cloud_profiles.forms import (RegisterCertForm, ProfileUpdateForm,
                                   RegisterForm, PasswordResetForm)
 
-from cloud_profiles.ldap_users import get_users as get_ldap_users
+from cloud_profiles.utils import chunked, commit_on_success
 
 
 # Mixin for site admin views
@@ -106,30 +113,139 @@ class SelfProfileModify(BaseProfileModify):
     success_url = reverse_lazy('profile')
 
     def get_object(self, *args, **kwargs):
-        return self.request.user.profile
+        # request.user.profile may come from the X509Backend cache, the
+        # update saves every field so it has to start from the db row
+        return get_object_or_404(Profile, user=self.request.user)
 
 
 class ProfileList(StaffView, ListView):
+    """
+    Profiles ordered by pk, paginated by seeking from the first or last pk
+    of the current page (?after= / ?before=) instead of using offsets
+    """
     model = Profile
     context_object_name = 'profiles'
+    template_name = 'cloud_profiles/profile_list.html'
+    page_size = 50
+    filter_fields = ('status', 'country', 'institution')
+
+    def get_filters(self):
+        return dict((f, self.request.GET[f]) for f in self.filter_fields
+                    if self.request.GET.get(f))
+
+    def get_pk_param(self, name):
+        try:
+            return int(self.request.GET[name])
+        except (KeyError, ValueError):
+            return None
+
+    def get_queryset(self):
+        qs = Profile.objects.filter(**self.get_filters())
+        self.after = self.get_pk_param('after')
+        self.before = self.get_pk_param('before')
+        if self.before is not None:
+            qs = qs.filter(pk__lt=self.before).order_by('-pk')
+        else:
+            if self.after is not None:
+                qs = qs.filter(pk__gt=self.after)
+            qs = qs.order_by('pk')
+        profiles = list(qs[:self.page_size + 1])
+        self.has_more = len(profiles) > self.page_size
+        profiles = profiles[:self.page_size]
+        if self.before is not None:
+            profiles.reverse()
+        return profiles
+
+    def get_context_data(self, **kwargs):
+        ctx = super(ProfileList, self).get_context_data(**kwargs)
+        profiles = self.object_list
+        filters = self.get_filters()
+        if self.before is not None:
+            has_prev, has_next = self.has_more, True
+        else:
+            has_prev, has_next = self.after is not None, self.has_more
+        ctx.update({
+            'filters': filters,
+            'status_choices': Profile.STATUS,
+            'country_choices': COUNTRIES,
+            'filter_query': urlencode(filters),
+            'next_after': profiles[-1].pk if profiles and has_next else None,
+            'prev_before': profiles[0].pk if profiles and has_prev else None,
+        })
+        return ctx
 
 
 class UserList(SiteAdminView, TemplateView):
+    """
+    Lists the accounts of the local mirror of the directory, see the
+    sync_directory command. The accounts are read and joined with the
+    profiles in chunks, but {% for %} turns the generator into a list,
+    so the page holds all of them when it is rendered. The export view
+    (UserExport) streams them.
+    """
     template_name = 'cloud_profiles/user_list.html'
 
+    # max number of emails per IN (...) lookup
+    chunk_size = 500
+
+    def get_statuses(self, emails):
+        statuses = {}
+        for chunk in chunked(emails, self.chunk_size):
+            qs = Profile.objects.filter(email__in=chunk)
+            statuses.update(qs.values_list('email', 'status'))
+        return statuses
+
+    def get_accounts(self):
+        accounts = DirectoryAccount.objects.order_by('email')
+        return accounts.values('dn', 'email', 'name').iterator()
+
+    def iter_users(self):
+        # directory entries are joined with the profiles one chunk at a time
+        for chunk in chunked(self.get_accounts(), self.chunk_size):
+            statuses = self.get_statuses([u['email'] for u in chunk])
+            for u in chunk:
+                u['status'] = statuses.get(u['email'], 'EX')
+                yield u
+
     def get_context_data(self, **kwargs):
-        users = get_ldap_users()
-        for u in users:
-            try: 
-                profile = Profile.objects.get(email=u['email'])
-                u['status'] = profile.status
-            except Profile.DoesNotExist:
-                u['status'] = 'EX'
         ctx = super(UserList, self).get_context_data(**kwargs)
-        ctx['users'] = users
+        ctx['users'] = self.iter_users()
         return ctx
 
 
+# Mixin for views that stream the rows of their get_rows(fmt) as an
+# attachment, in the format of the ?format= parameter
+class ExportView(object):
+    filename = 'export'
+
+    def get(self, request, *args, **kwargs):
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in export.FORMATS:
+            return HttpResponseBadRequest('Unknown format %s' % fmt)
+        response = StreamingHttpResponse(self.get_rows(fmt),
+                                         content_type=export.CONTENT_TYPES[fmt])
+        response['Content-Disposition'] = ('attachment; filename=%s.%s' %
+                                           (self.filename, fmt))
+        return response
+
+
+class ProfileExport(StaffView, ExportView, View):
+    filename = 'profiles'
+
+    def get_rows(self, fmt):
+        filters = dict((f, self.request.GET[f])
+                       for f in ProfileList.filter_fields
+                       if self.request.GET.get(f))
+        return export.export_profiles(fmt, filters)
+
+
+class UserExport(SiteAdminView, ExportView, View):
+    filename = 'ldap-users'
+
+    def get_rows(self, fmt):
+        return export.export_accounts(fmt)
+
+
 class ProfileDel(StaffView, DeleteView):
     model = Profile
     success_url = reverse_lazy('profiles')
@@ -137,6 +253,10 @@ class ProfileDel(StaffView, DeleteView):
 
 # confirm the registration from user
 class ProfileConfirm(TemplateView):
+    @method_decorator(throttled('confirm'))
+    def dispatch(self, request, *args, **kwargs):
+        return super(ProfileConfirm, self).dispatch(request, *args, **kwargs)
+
     def notify_admins(self, profile):
         ctxt = {
             'site': RequestSite(self.request),
@@ -145,14 +265,14 @@ class ProfileConfirm(TemplateView):
         body = loader.render_to_string('cloud_profiles/admin_notice_email.txt',
                                        ctxt).strip()
         subject = 'New ibercloud account registered'
-        send_mail(subject, body, 'ibergrid cloud <support@ibergrid.eu>',
-                  # XXX fix this
-                  ['enolfc@ifca.unican.es', 'isabel@campos-it.es'])
+        queue_mail(subject, body, 'ibergrid cloud <support@ibergrid.eu>',
+                   # XXX fix this
+                   ['enolfc@ifca.unican.es', 'isabel@campos-it.es'])
 
     def get_context_data(self, **kwargs):
         confirmation_key = kwargs.get('confirmation_key', '')
-        profile = get_object_or_404(Profile,
-                                    confirmation_key=confirmation_key)
+        profile = get_object_or_404(
+            Profile.objects.with_token('confirmation', confirmation_key))
         if profile.confirm():
             self.notify_admins(profile)
             self.template_name = 'cloud_profiles/confirm_ok.html'
@@ -161,48 +281,113 @@ class ProfileConfirm(TemplateView):
         return super(ProfileConfirm, self).get_context_data(**kwargs)
 
 
+def activation_email(request, profile):
+    ctxt = {
+        'site': RequestSite(request),
+        'profile': profile,
+        'token': profile.password_token,
+    }
+    body = loader.render_to_string('cloud_profiles/activation_email.txt',
+                                   ctxt).strip()
+    subject = 'Your Ibercloud account is now active'
+    return (subject, body, 'ibergrid cloud <support@ibergrid.eu>',
+            [profile.email])
+
+
+def activation_queued(request, count):
+    # the accounts are created later by apply_directory_ops, which may fail
+    url = reverse('admin:cloud_profiles_directoryoperation_changelist')
+    messages.success(request, format_html(
+        '{0} profiles activated, their LDAP accounts are queued for creation '
+        '(<a href="{1}?status__exact={2}">pending directory operations</a>)',
+        count, url, DirectoryOperation.PENDING))
+
+
+def activate_profiles(request, profiles):
+    """
+    Activates several profiles at once and queues their emails, the
+    result of each profile is reported with the messages framework
+    """
+    profiles = dict((p.pk, p) for p in profiles)
+    results = Profile.objects.activate_profiles(profiles.values())
+    activated = [profiles[pk] for pk, error in results.items() if not error]
+    queue_mails([activation_email(request, p) for p in activated])
+    if activated:
+        activation_queued(request, len(activated))
+    for pk, error in results.items():
+        if error:
+            messages.error(request, 'Unable to activate %s: %s' %
+                                    (profiles[pk].email, error))
+    return results
+
+
 # activate one user
 class ProfileActivate(StaffView, RedirectView):
     permanent = False
 
     def send_password_reset_email(self, profile):
-        ctxt = {
-            'site': RequestSite(self.request),
-            'profile': profile,
-        }
-        body = loader.render_to_string('cloud_profiles/activation_email.txt',
-                                       ctxt).strip()
-        subject = 'Your Ibercloud account is now active'
-        send_mail(subject, body, 'ibergrid cloud <support@ibergrid.eu>',
-                  [profile.email])
-
+        queue_mail(*activation_email(self.request, profile))
 
     def get_redirect_url(self, pk):
         redirect_url = reverse('profiles')
         profile = get_object_or_404(Profile, pk=pk)
-        profile.activate()
-        self.send_password_reset_email(profile)
+        if profile.activate():
+            self.send_password_reset_email(profile)
+            activation_queued(self.request, 1)
+        else:
+            messages.error(self.request, 'Unable to activate %s: profile '
+                                         'is not pending activation' %
+                                         profile.email)
         return redirect_url
 
 
+# send a new activation link to an activated user
+class ProfileResendActivation(StaffView, RedirectView):
+    permanent = False
+
+    def get_redirect_url(self, pk):
+        profile = get_object_or_404(Profile, pk=pk)
+        if profile.reissue_password_key():
+            queue_mail(*activation_email(self.request, profile))
+            messages.success(self.request, 'Activation link sent to %s' %
+                                           profile.email)
+        else:
+            messages.error(self.request, '%s is not activated' %
+                                         profile.email)
+        return reverse('profiles')
+
+
+# activate the users selected in the profile list
+class ProfileBulkActivate(StaffView, View):
+    def post(self, request, *args, **kwargs):
+        ids = request.POST.getlist('profile')
+        if ids:
+            profiles = Profile.objects.filter(pk__in=ids)
+            activate_profiles(request, profiles.select_related('user'))
+        return redirect(reverse('profiles'))
+
+
 class ResetPassword(FormView):
     template_name = 'cloud_profiles/reset_password.html'
     form_class = PasswordResetForm
     success_url = reverse_lazy('home')
     profile = None
 
+    @method_decorator(throttled('reset-password'))
+    def dispatch(self, request, *args, **kwargs):
+        return super(ResetPassword, self).dispatch(request, *args, **kwargs)
+
     def get(self, request, *args, **kwargs):
         key = kwargs.get('password_key', '')
-        get_object_or_404(Profile,
-                          password_key=key,
+        get_object_or_404(Profile.objects.with_token('password', key),
                           status=Profile.VALID)
         return super(ResetPassword, self).get(request, *args, **kwargs)
 
     def post(self, request, *args, **kwargs):
         key = kwargs.get('password_key', '')
-        self.profile = get_object_or_404(Profile,
-                                         password_key=key,
-                                         status=Profile.VALID)
+        self.profile = get_object_or_404(
+            Profile.objects.with_token('password', key),
+            status=Profile.VALID)
         return super(ResetPassword, self).post(request, *args, **kwargs)
 
     def form_valid(self, form):
@@ -223,12 +408,13 @@ class RegisterProfile(FormView):
         ctxt = {
             'site': RequestSite(self.request),
             'profile': profile,
+            'token': profile.confirmation_token,
         }
         body = loader.render_to_string('cloud_profiles/registration_email.txt',
                                        ctxt).strip()
         subject = 'Ibercloud account confirmation'
-        send_mail(subject, body, 'ibergrid cloud <support@ibergrid.eu>',
-                  [profile.email])
+        queue_mail(subject, body, 'ibergrid cloud <support@ibergrid.eu>',
+                   [profile.email])
 
 
     def form_valid(self, form):
@@ -236,25 +422,26 @@ class RegisterProfile(FormView):
         research_area = form.cleaned_data.get('research_area', '')
         description = form.cleaned_data.get('description', '')
         resources = form.cleaned_data.get('resources', '')
-        # create the user
-        p = Profile.objects.new_profile(name=form.cleaned_data['name'],
-                                        email=form.cleaned_data['email'],
-                                        phone=form.cleaned_data['phone'],
-                                        institution=form.cleaned_data['institution'],
-                                        country=form.cleaned_data['country'],
-                                        research_area=research_area,
-                                        description=description,
-                                        resources=resources)
-        if self.user_dn:
-            p.user_dn = self.user_dn
-        p.save()
-        self.send_confirmation_email(p)
+        # the user, the profile and the queued email are created together
+        with commit_on_success():
+            p = Profile.objects.new_profile(name=form.cleaned_data['name'],
+                                            email=form.cleaned_data['email'],
+                                            phone=form.cleaned_data['phone'],
+                                            institution=form.cleaned_data['institution'],
+                                            country=form.cleaned_data['country'],
+                                            research_area=research_area,
+                                            description=description,
+                                            resources=resources,
+                                            user_dn=self.user_dn or '')
+            self.send_confirmation_email(p)
         return super(RegisterProfile, self).form_valid(form)
 
     def get_context_data(self, **kwargs):
         kwargs['user_dn'] = self.user_dn
         return super(RegisterProfile, self).get_context_data(**kwargs)
 
+    # loading the form is cheap, only the submissions are limited
+    @method_decorator(throttled('registration', methods=('POST',)))
     def dispatch(self, request, *args, **kwargs):
         if 'SSL_CLIENT_S_DN' in request.META:
             self.user_dn = request.META['SSL_CLIENT_S_DN']
@@ -0,0 +1,43 @@
+#
+# Compiles the templates of the portal ahead of the first request, see
+# ibercloud/wsgi.py. Only useful with the cached template loader.
+#
+
+import logging
+import os
+
+from django.conf import settings
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, loader
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+def template_names():
+    """
+    Names of the templates of cloud_profiles, e.g. cloud_profiles/login.html,
+    and of TEMPLATE_DIRS, which has the base.html they extend
+    """
+    names = set()
+    for templates_dir in (TEMPLATES_DIR,) + tuple(settings.TEMPLATE_DIRS):
+        for root, dirs, files in os.walk(templates_dir):
+            for f in files:
+                path = os.path.join(root, f)
+                names.add(os.path.relpath(path, templates_dir))
+    return sorted(names)
+
+
+def warm_templates(names=None):
+    """
+    Loads each template so that the cached loader keeps it compiled.
+    Returns the number of templates loaded.
+    """
+    loaded = 0
+    for name in names or template_names():
+        try:
+            loader.get_template(name)
+            loaded += 1
+        except (TemplateDoesNotExist, TemplateSyntaxError) as e:
+            logger.warning('Unable to compile template %s: %s', name, e)
+    return loaded
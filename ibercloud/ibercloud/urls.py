@@ -6,12 +6,15 @@ admin.autodiscover()
 
 from django.views.generic.base import TemplateView
 
+from ibercloud.views import metrics_view
+
 urlpatterns = patterns('',
     url(r'^$', TemplateView.as_view(template_name='index.html'),
         name='home'),
     url(r'^support$', TemplateView.as_view(template_name='support.html'),
         name='support'),
     url(r'^profiles/', include('cloud_profiles.urls')),
+    url(r'^metrics$', metrics_view, name='metrics'),
     # Uncomment the admin/doc line below to enable admin documentation:
     #url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
     # Uncomment the next line to enable the admin:
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from cloud_profiles import metrics
+
+
+def metrics_view(request):
+    """
+    Prometheus metrics, only for the addresses in
+    CLOUD_PROFILES_METRICS_ALLOWED_IPS
+    """
+    allowed = getattr(settings, 'CLOUD_PROFILES_METRICS_ALLOWED_IPS',
+                      ('127.0.0.1',))
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
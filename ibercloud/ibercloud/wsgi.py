@@ -38,6 +38,10 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "ibercloud.settings"
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# compile the templates now instead of in the first requests
+from cloud_profiles.warmup import warm_templates
+warm_templates()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)